@@ -1,68 +1,323 @@
-import os
-import sqlite3
-import psycopg2
-import psycopg2.extras
-
-# ---- Настройки ----
-SQLITE_FILE = "telegram_promo_bot.db"
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-if DATABASE_URL is None:
-    raise RuntimeError("DATABASE_URL is not set")
-
-if DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-
-# ---- Подключения ----
-sqlite_conn = sqlite3.connect(SQLITE_FILE)
-sqlite_conn.row_factory = sqlite3.Row
-sqlite_cur = sqlite_conn.cursor()
-
-pg_conn = psycopg2.connect(DATABASE_URL)
-pg_cur = pg_conn.cursor()
-
-# ---- Маппинг: уникальные ключи для UPSERT ----
-# Чтобы знать, по какому полю обновлять
-unique_keys = {
-    "users": ["tg_id"],
-    "promocodes": ["code"],
-    "settings": ["key"],
-    "distribution": ["id"],     # тут по id (SERIAL PK)
-    "weekly_users": ["id"],     # тут по id (SERIAL PK)
-}
-
-# ---- Перенос данных ----
-for table, keys in unique_keys.items():
-    print(f"Переносим таблицу: {table}")
-    rows = sqlite_cur.execute(f"SELECT * FROM {table}").fetchall()
-    if not rows:
-        print("  → нет данных")
-        continue
-
-    columns = rows[0].keys()
-    col_list = ", ".join(columns)
-    placeholders = ", ".join(["%s"] * len(columns))
-
-    conflict_cols = ", ".join(keys)
-    update_set = ", ".join([f"{col}=EXCLUDED.{col}" for col in columns if col not in keys])
-
-    for row in rows:
-        values = [row[c] for c in columns]
-        query = f"""
-            INSERT INTO {table} ({col_list})
-            VALUES ({placeholders})
-            ON CONFLICT ({conflict_cols})
-            DO UPDATE SET {update_set}
-        """
-        try:
-            pg_cur.execute(query, values)
-        except Exception as e:
-            print(f"  ⚠️ ошибка при вставке строки {dict(row)}: {e}")
-
-pg_conn.commit()
-print("✅ Миграция завершена! Данные из SQLite теперь в PostgreSQL.")
-
-# ---- Закрываем соединения ----
-sqlite_conn.close()
-pg_cur.close()
-pg_conn.close()
+import csv
+import io
+import os
+import sqlite3
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from urllib.parse import urlparse
+
+import psycopg2
+import psycopg2.extras
+
+# ---- Настройки ----
+SQLITE_FILE = "telegram_promo_bot.db"
+DATABASE_URL = os.getenv("DATABASE_URL")
+BATCH_SIZE = 10000  # сколько строк SQLite читаем за раз
+REJECTS_FILE = "migration_rejects.log"  # сюда пишем строки, которые не удалось вставить
+
+if DATABASE_URL is None:
+    raise RuntimeError("DATABASE_URL is not set")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+# ---- Маппинг: уникальные ключи для UPSERT ----
+# Чтобы знать, по какому полю обновлять
+unique_keys = {
+    "users": ["tg_id"],
+    "promocodes": ["code"],
+    "settings": ["key"],
+    "distribution": ["id"],     # тут по id (SERIAL PK)
+    "weekly_users": ["id"],     # тут по id (SERIAL PK)
+}
+
+# Неявные FK-зависимости между таблицами: детей грузим после родителей.
+table_deps = {
+    "users": [],
+    "promocodes": [],
+    "settings": [],
+    "distribution": ["users", "promocodes"],
+    "weekly_users": ["users"],
+}
+
+
+def dependency_levels(deps):
+    """Топологическая сортировка по «волнам»: внутри волны таблицы независимы."""
+    levels = []
+    done = set()
+    pending = dict(deps)
+    while pending:
+        ready = tuple(t for t, ds in pending.items() if all(d in done for d in ds))
+        if not ready:
+            raise RuntimeError(f"циклические зависимости таблиц: {sorted(pending)}")
+        levels.append(ready)
+        done.update(ready)
+        for t in ready:
+            del pending[t]
+    return levels
+
+
+def connect_pg():
+    """Соединение Postgres, настроенное под bulk-загрузку."""
+    kwargs = {
+        "keepalives": 1,
+        # synchronous_commit на сессию (одноразовая миграция), work_mem
+        # побольше для финального INSERT ... SELECT из staging.
+        "options": "-c synchronous_commit=off -c work_mem=256MB -c maintenance_work_mem=512MB",
+    }
+    # Локальный Postgres быстрее через unix-сокет, чем через TCP loopback.
+    if urlparse(DATABASE_URL).hostname in ("localhost", "127.0.0.1"):
+        kwargs["host"] = "/var/run/postgresql"
+    conn = psycopg2.connect(DATABASE_URL, **kwargs)
+    conn.set_session(autocommit=False)
+    return conn
+
+
+def render_csv(rows) -> io.StringIO:
+    """Рендерим пачку строк в CSV для COPY (NULL кодируем как \\N)."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(["\\N" if v is None else v for v in row])
+    buf.seek(0)
+    return buf
+
+
+# ---- COPY BINARY: кодировщики для типов наших таблиц ----
+# Бинарный COPY обходит текстовый парсинг на стороне Postgres и форматирование
+# на клиенте; SQLite хранит даты/время текстом, поэтому парсим их здесь.
+_PG_EPOCH_TS = datetime(2000, 1, 1)
+_PG_EPOCH_DATE = date(2000, 1, 1)
+
+
+def _enc_timestamp(v):
+    if isinstance(v, str):
+        v = datetime.fromisoformat(v)
+    return struct.pack(">q", round((v - _PG_EPOCH_TS).total_seconds() * 1_000_000))
+
+
+def _enc_date(v):
+    if isinstance(v, str):
+        v = date.fromisoformat(v)
+    return struct.pack(">i", (v - _PG_EPOCH_DATE).days)
+
+
+BINARY_ENCODERS = {
+    "smallint": lambda v: struct.pack(">h", int(v)),
+    "integer": lambda v: struct.pack(">i", int(v)),
+    "bigint": lambda v: struct.pack(">q", int(v)),
+    "text": lambda v: str(v).encode("utf-8"),
+    "character varying": lambda v: str(v).encode("utf-8"),
+    "boolean": lambda v: b"\x01" if v else b"\x00",
+    "timestamp without time zone": _enc_timestamp,
+    "date": _enc_date,
+}
+
+# сигнатура + флаги + расширение заголовка
+_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_BINARY_NULL = struct.pack(">i", -1)
+
+
+def render_binary(rows, encoders) -> io.BytesIO:
+    """Рендерим пачку строк в бинарный формат COPY."""
+    buf = io.BytesIO()
+    buf.write(_BINARY_HEADER)
+    ncols = struct.pack(">h", len(encoders))
+    for row in rows:
+        buf.write(ncols)
+        for enc, v in zip(encoders, row):
+            if v is None:
+                buf.write(_BINARY_NULL)
+            else:
+                data = enc(v)
+                buf.write(struct.pack(">i", len(data)))
+                buf.write(data)
+    buf.write(struct.pack(">h", -1))  # трейлер
+    buf.seek(0)
+    return buf
+
+
+def log_reject(table, row, err):
+    """Отбракованные строки складываем в append-only файл, а не в stdout."""
+    with open(REJECTS_FILE, "a", encoding="utf-8") as f:
+        f.write(f"{table}\t{row!r}\t{err}\n")
+
+
+def upsert_values_bisect(pg_cur, values_upsert_sql, batch, table) -> int:
+    """UPSERT пачки с бисекцией при ошибке.
+
+    Откатываемся к SAVEPOINT и делим пачку пополам, пока не останется
+    единственная плохая строка — её логируем и пропускаем. Счастливый путь
+    платит за один execute_values, а не за try/except на каждую строку.
+    Возвращает число успешно вставленных строк.
+    """
+    pg_cur.execute("SAVEPOINT bisect_sp")
+    try:
+        psycopg2.extras.execute_values(pg_cur, values_upsert_sql, batch, page_size=500)
+        pg_cur.execute("RELEASE SAVEPOINT bisect_sp")
+        return len(batch)
+    except Exception as e:
+        pg_cur.execute("ROLLBACK TO SAVEPOINT bisect_sp")
+        if len(batch) == 1:
+            log_reject(table, batch[0], e)
+            return 0
+        mid = len(batch) // 2
+        return (upsert_values_bisect(pg_cur, values_upsert_sql, batch[:mid], table)
+                + upsert_values_bisect(pg_cur, values_upsert_sql, batch[mid:], table))
+
+
+def migrate_table(table: str, keys):
+    """Переносит одну таблицу; соединения свои на поток (для ThreadPoolExecutor)."""
+    print(f"Переносим таблицу: {table}")
+    # row_factory не ставим: обычные кортежи дешевле sqlite3.Row
+    # (нет поименованного __getitem__ на каждую колонку каждой строки),
+    # а порядок колонок и так фиксирован через cursor.description.
+    sqlite_conn = sqlite3.connect(SQLITE_FILE)
+    pg_conn = connect_pg()
+    try:
+        sqlite_cur = sqlite_conn.cursor()
+        pg_cur = pg_conn.cursor()
+
+        # Доверенная одноразовая миграция: отключаем пользовательские триггеры
+        # и FK-проверки на время загрузки (роль replica), в конце возвращаем.
+        # На managed Postgres (Render) смена роли требует superuser — тогда
+        # просто грузим с включёнными проверками.
+        replica_role = True
+        try:
+            pg_cur.execute("SET session_replication_role = replica")
+        except Exception as e:
+            pg_conn.rollback()
+            replica_role = False
+            print(f"  ⚠️ {table}: роль replica недоступна ({e}), грузим с проверками")
+
+        sqlite_cur.execute(f"SELECT * FROM {table}")
+        columns = [d[0] for d in sqlite_cur.description]
+        first_batch = sqlite_cur.fetchmany(BATCH_SIZE)
+        if not first_batch:
+            print(f"  {table}: нет данных")
+            return
+
+        # Явная транзакция на таблицу: один commit/fsync вместо commit на строку
+        # (synchronous_commit уже выключен на уровне сессии в connect_pg).
+        pg_cur.execute("BEGIN")
+
+        col_list = ", ".join(columns)
+        conflict_cols = ", ".join(keys)
+        update_set = ", ".join([f"{col}=EXCLUDED.{col}" for col in columns if col not in keys])
+
+        # Типы колонок в Postgres → кодировщики для COPY BINARY;
+        # если встретился тип без кодировщика, остаёмся на CSV.
+        pg_cur.execute(
+            "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = %s",
+            (table,),
+        )
+        type_map = dict(pg_cur.fetchall())
+        encoders = [BINARY_ENCODERS.get(type_map.get(col, "")) for col in columns]
+        if all(encoders):
+            with_clause = "WITH (FORMAT BINARY)"
+            render_batch = lambda batch: render_binary(batch, encoders)
+        else:
+            with_clause = "WITH (FORMAT CSV, NULL '\\N')"
+            render_batch = render_csv
+
+        # Снимаем вторичные (неуникальные) индексы на время загрузки: один
+        # CREATE INDEX по готовым данным дешевле, чем обновление индекса на
+        # каждую строку. Уникальные не трогаем — они нужны для ON CONFLICT.
+        pg_cur.execute(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE tablename = %s AND indexdef NOT LIKE 'CREATE UNIQUE%%'",
+            (table,),
+        )
+        saved_indexes = pg_cur.fetchall()
+        for idx_name, _ in saved_indexes:
+            pg_cur.execute(f"DROP INDEX {idx_name}")
+
+        # Если целевая таблица пуста (обычный случай одноразовой миграции),
+        # конфликтовать не с чем: COPY сразу в неё, без staging и UPSERT —
+        # Postgres не тратит время на проверку уникальных индексов по строке.
+        pg_cur.execute(f"SELECT 1 FROM {table} LIMIT 1")
+        dest_empty = pg_cur.fetchone() is None
+
+        if dest_empty:
+            copy_sql = f"COPY {table} ({col_list}) FROM STDIN {with_clause}"
+            upsert_sql = None
+        else:
+            # Одна временная staging-таблица на таблицу: COPY туда без проверок,
+            # затем единственный INSERT ... ON CONFLICT из staging в целевую.
+            staging = f"stg_{table}"
+            pg_cur.execute(f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+            copy_sql = f"COPY {staging} ({col_list}) FROM STDIN {with_clause}"
+            upsert_sql = f"""
+                INSERT INTO {table} ({col_list})
+                SELECT {col_list} FROM {staging}
+                ON CONFLICT ({conflict_cols})
+                DO UPDATE SET {update_set}
+            """
+        # Запасной вариант, если COPY пачки не прошёл (например, кривые данные):
+        # один multi-VALUES UPSERT на всю пачку вместо execute по строке.
+        values_upsert_sql = f"""
+            INSERT INTO {table} ({col_list})
+            VALUES %s
+            ON CONFLICT ({conflict_cols})
+            DO UPDATE SET {update_set}
+        """
+
+        total = 0
+        batch = first_batch
+        while batch:
+            # SAVEPOINT вокруг пачки: ошибка одной пачки не «отравляет» транзакцию
+            # всей таблицы (после abort psycopg2 иначе отвергает все запросы).
+            pg_cur.execute("SAVEPOINT batch_sp")
+            try:
+                pg_cur.copy_expert(copy_sql, render_batch(batch))
+                total += len(batch)
+            except Exception as e:
+                pg_cur.execute("ROLLBACK TO SAVEPOINT batch_sp")
+                print(f"  ⚠️ {table}: COPY пачки не прошёл ({len(batch)} строк): {e}, пробуем execute_values")
+                inserted = upsert_values_bisect(pg_cur, values_upsert_sql, batch, table)
+                total += inserted
+                if inserted < len(batch):
+                    print(f"  ⚠️ {table}: {len(batch) - inserted} строк отбраковано, см. {REJECTS_FILE}")
+            batch = sqlite_cur.fetchmany(BATCH_SIZE)
+
+        if upsert_sql is not None:
+            pg_cur.execute("SAVEPOINT upsert_sp")
+            try:
+                pg_cur.execute(upsert_sql)
+            except Exception as e:
+                pg_cur.execute("ROLLBACK TO SAVEPOINT upsert_sp")
+                print(f"  ⚠️ {table}: ошибка при UPSERT из staging: {e}")
+
+        # Возвращаем снятые индексы и обновляем статистику планировщика.
+        for _, idx_def in saved_indexes:
+            pg_cur.execute(idx_def)
+        pg_conn.commit()
+        if replica_role:
+            pg_cur.execute("SET session_replication_role = origin")
+        # COPY переносит явные id, поэтому sequence остаётся позади MAX(id);
+        # без setval первый INSERT после миграции падает на duplicate key
+        # (бутстрап бота чинит sequence только при смене версии схемы)
+        if "id" in columns:
+            pg_cur.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {table}), 1))"
+            )
+        pg_cur.execute(f"ANALYZE {table}")
+        pg_conn.commit()
+        print(f"  {table}: перенесено строк: {total}")
+    finally:
+        # обязательно закрываем соединения потока, иначе выедим пул Postgres
+        sqlite_conn.close()
+        pg_conn.close()
+
+
+def main():
+    for level in dependency_levels(table_deps):
+        with ThreadPoolExecutor(max_workers=len(level)) as ex:
+            list(ex.map(lambda t: migrate_table(t, unique_keys[t]), level))
+    print("✅ Миграция завершена! Данные из SQLite теперь в PostgreSQL.")
+
+
+if __name__ == "__main__":
+    main()
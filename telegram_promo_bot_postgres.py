@@ -1,12 +1,15 @@
 import os
 import asyncio
-import html
+import sys
+import time
+from collections import Counter, deque
 from datetime import datetime, timedelta
 from typing import List, Optional, Dict
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -15,14 +18,23 @@ from aiogram.fsm.state import StatesGroup, State
 from datetime import datetime, timedelta, timezone, date
 from aiohttp import web
 
+# uvloop, if available, speeds up the whole I/O-bound event loop (Telegram +
+# DB sockets) with no handler changes; not available on Windows
+if sys.platform != "win32":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
 # ---------------- CONFIG ----------------
 # Token: keep fallback to original value so local usage doesn't break; you can set BOT_TOKEN in env on Render
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 admin_ids_str = os.getenv("ADMIN_IDS", "")
 try:
-    ADMIN_IDS = [int(x.strip()) for x in admin_ids_str.split(",") if x.strip()]
+    ADMIN_IDS = frozenset(int(x.strip()) for x in admin_ids_str.split(",") if x.strip())
 except ValueError:
-    ADMIN_IDS = []
+    ADMIN_IDS = frozenset()
 
 # ---------------- DB SETUP (Postgres if DATABASE_URL present, otherwise fallback to SQLite) ----------------
 USE_POSTGRES = False
@@ -31,220 +43,497 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if DATABASE_URL:
     USE_POSTGRES = True
     # psycopg2 imported lazily to avoid import errors when only using sqlite locally
+    import threading
+
     import psycopg2
+    import psycopg2.extensions
     import psycopg2.extras
+    import psycopg2.pool
 
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-    conn = psycopg2.connect(DATABASE_URL)
-    # Keep raw cursor factory for creating RealDictCursor when needed
-    raw_pg_cursor = conn.cursor
+    # Connection pool instead of a single global connection: one shared conn
+    # serializes every query in the bot behind a single socket. Connections are
+    # handed out lazily per thread (handlers can run in executor workers), while
+    # the existing get_cursor() / conn.commit() call sites keep working.
+    # Pool ceiling covers every thread that can touch the DB: asyncio.to_thread
+    # uses the default executor (min(32, cpu_count+4) workers) plus the event
+    # loop thread itself — undersizing it makes getconn() raise PoolError.
+    _EXECUTOR_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+    pg_pool = psycopg2.pool.ThreadedConnectionPool(
+        1,
+        max(int(os.getenv("DB_POOL_SIZE", "10")), _EXECUTOR_WORKERS + 1),
+        DATABASE_URL,
+    )
+    _db_local = threading.local()
+
+    # server-side prepared statements for the hottest lookups: Postgres parses
+    # and plans them once per connection instead of on every call
+    _PREPARED_STATEMENTS = (
+        "PREPARE get_user_by_tgid (bigint) AS SELECT * FROM users WHERE tg_id = $1",
+        "PREPARE get_user_by_site (text) AS SELECT * FROM users WHERE site_username = $1",
+    )
 
+    # PREPARE needs the tables to exist, so connections checked out during the
+    # bootstrap DDL below skip it; the flag flips once the schema is in place.
+    _schema_ready = False
 
-    def get_cursor():
-        real_cur = raw_pg_cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        class CursorWrapper:
-            def __init__(self, rc):
-                self._rc = rc
-            def execute(self, query, params=None):
+    def _prepare_statements(c):
+        cur = c.cursor()
+        try:
+            for stmt in _PREPARED_STATEMENTS:
+                cur.execute(stmt)
+            c.commit()
+        finally:
+            cur.close()
+
+    def _thread_conn():
+        c = getattr(_db_local, "conn", None)
+        if c is not None and c.closed:
+            # вернуть слот пула: иначе каждый обрыв соединения (рестарт БД)
+            # навсегда съедает одно место в _used
+            try:
+                pg_pool.putconn(c, close=True)
+            except Exception:
+                pass
+            c = None
+        if c is None:
+            c = pg_pool.getconn()
+            # connection-wide factory: и get_cursor(), и conn.cursor() отдают
+            # dict-строки без передачи cursor_factory на каждый вызов
+            c.cursor_factory = BotCursor
+            if _schema_ready:
+                _prepare_statements(c)
+            _db_local.conn = c
+        return c
+
+    class _ConnectionProxy:
+        """Stands in for the old module-level conn; delegates to the pooled per-thread connection."""
+        def commit(self):
+            _thread_conn().commit()
+        def rollback(self):
+            _thread_conn().rollback()
+        def cursor(self, *args, **kwargs):
+            return _thread_conn().cursor(*args, **kwargs)
+
+    conn = _ConnectionProxy()
+
+    def _db_done():
+        # read-only closures never commit, so their SELECT leaves the parked
+        # connection idle-in-transaction; end the transaction before the
+        # worker thread goes back to the executor
+        c = getattr(_db_local, "conn", None)
+        if c is None or c.closed:
+            return
+        status = c.get_transaction_status()
+        if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                c.rollback()
+            except Exception:
+                pass
+
+
+    class BotCursor(psycopg2.extras.RealDictCursor):
+        """RealDictCursor that rolls the transaction back on a failed statement
+        so the pooled connection isn't left in the aborted state. All
+        Postgres-path SQL in this module already uses %s placeholders."""
+        def execute(self, query, vars=None):
+            try:
+                return super().execute(query, vars)
+            except Exception:
                 try:
-                    if params is not None and "?" in query:
-                        q = query.replace("?", "%s")
-                        return self._rc.execute(q, params)
-                    return self._rc.execute(query, params) if params is not None else self._rc.execute(query)
+                    self.connection.rollback()
                 except Exception:
-                    try:
-                        conn.rollback()
-                    except Exception:
-                        pass
-                    raise
-            def executemany(self, query, seq_of_params):
+                    pass
+                raise
+        def executemany(self, query, vars_list):
+            try:
+                return super().executemany(query, vars_list)
+            except Exception:
                 try:
-                    if "?" in query:
-                        q = query.replace("?", "%s")
-                        return self._rc.executemany(q, seq_of_params)
-                    return self._rc.executemany(query, seq_of_params)
+                    self.connection.rollback()
                 except Exception:
-                    try:
-                        conn.rollback()
-                    except Exception:
-                        pass
-                    raise
-            def fetchone(self): return self._rc.fetchone()
-            def fetchall(self): return self._rc.fetchall()
-            def __getattr__(self, name): return getattr(self._rc, name)
-        return CursorWrapper(real_cur)
-
-    # override connection.cursor to return our wrapper (so existing code calling conn.cursor() works)
-
-    # create tables for Postgres (SERIAL, BIGINT, etc.)
-    c = get_cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        tg_id BIGINT UNIQUE,
-        tg_username TEXT,
-        site_username TEXT,
-        role TEXT DEFAULT 'user',
-        status TEXT DEFAULT 'pending',
-        rejected_at TIMESTAMP,
-        registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS promocodes (
-        id SERIAL PRIMARY KEY,
-        code TEXT UNIQUE,
-        total_uses INTEGER,
-        used INTEGER DEFAULT 0,
-        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    );
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS distribution (
-        id SERIAL PRIMARY KEY,
-        user_id BIGINT,
-        promo_id INTEGER,
-        code TEXT,
-        count INTEGER,
-        source TEXT,
-        given_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS weekly_users (
-        id SERIAL PRIMARY KEY,
-        week_start DATE,
-        position INTEGER,
-        site_username TEXT,
-        user_id BIGINT
-    );
-    """)
-    def fix_sequences():
-        if not USE_POSTGRES:
-            return
+                    pass
+                raise
+
+    def get_cursor():
+        return _thread_conn().cursor()
+
+    # Bootstrap DDL is skipped entirely when the stored schema version
+    # matches: warm starts cost one SELECT instead of ~15 DDL round-trips.
+    # Bump SCHEMA_VERSION whenever the DDL below changes.
+    SCHEMA_VERSION = "6"
+
+    def _stored_schema_version():
         c = get_cursor()
-        tables = ["users", "promocodes", "distribution", "weekly_users"]
-        for table in tables:
-            seq_name = f"{table}_id_seq"
-            try:
-                c.execute(f"CREATE SEQUENCE IF NOT EXISTS {seq_name};")
-                c.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{seq_name}');")
-                c.execute(f"ALTER SEQUENCE {seq_name} OWNED BY {table}.id;")
-                c.execute(f"""
-                    SELECT setval(
-                        '{seq_name}',
-                        COALESCE((SELECT MAX(id) FROM {table}), 1),
-                        true
-                    )
-                """)
-            except Exception as e:
-                print(f"⚠️ Ошибка фикса sequence для {table}: {e}")
+        c.execute("SELECT to_regclass('public.settings') AS reg")
+        if c.fetchone()["reg"] is None:
+            return None
+        c.execute("SELECT value FROM settings WHERE key = %s", ("schema_version",))
+        r = c.fetchone()
+        return r["value"] if r else None
+
+    if _stored_schema_version() != SCHEMA_VERSION:
+        # create tables for Postgres (SERIAL, BIGINT, etc.)
+        c = get_cursor()
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            tg_id BIGINT UNIQUE,
+            tg_username TEXT,
+            site_username TEXT,
+            role TEXT DEFAULT 'user',
+            status TEXT DEFAULT 'pending',
+            rejected_at TIMESTAMP,
+            rejected_until TIMESTAMP,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS promocodes (
+            id SERIAL PRIMARY KEY,
+            code TEXT UNIQUE,
+            total_uses INTEGER,
+            used INTEGER DEFAULT 0,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS distribution (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            promo_id INTEGER,
+            code TEXT,
+            count INTEGER,
+            source TEXT,
+            given_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS weekly_users (
+            id SERIAL PRIMARY KEY,
+            week_start DATE,
+            position INTEGER,
+            site_username TEXT,
+            user_id BIGINT
+        );
+        """)
+        # precomputed cooldown expiry for rejected users (older DBs lack it)
+        c.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS rejected_until TIMESTAMP;")
+        # composite indexes for the hot WHERE clauses (/promo, issued-codes
+        # prefetches, weekly list lookups, /pending) — without them these scan
+        # the whole table
+        c.execute("CREATE INDEX IF NOT EXISTS idx_dist_user_given ON distribution(user_id, given_at);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_dist_user_code ON distribution(user_id, code);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_weekly_week_pos ON weekly_users(week_start, position);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_status_reg ON users(status, registered_at);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_registered ON users(registered_at);")
+        # partial index: /pending scans only the (typically small) pending subset
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_pending ON users(registered_at) WHERE status = 'pending';")
+        # partial index: anti-join свободных пользователей (NOT EXISTS по week_start/user_id)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_weekly_week_user ON weekly_users(week_start, user_id) WHERE user_id IS NOT NULL;")
+        # promocodes ORDER BY added_at, id (givepromo/allocator)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_promo_added_id ON promocodes(added_at, id);")
+        # partial: только коды с остатком (WHERE total_uses > used)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_promo_active ON promocodes(added_at, id) WHERE total_uses > used;")
+        # поиск по нику сайта (/finduser, givepromo, проверка конфликта при регистрации)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_site ON users(site_username);")
+        # отчёты по датам выдач (/report -> итоги)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_dist_given_at ON distribution(given_at);")
+        def fix_sequences():
+            if not USE_POSTGRES:
+                return
+            c = get_cursor()
+            tables = ["users", "promocodes", "distribution", "weekly_users"]
+            for table in tables:
+                seq_name = f"{table}_id_seq"
+                try:
+                    c.execute(f"CREATE SEQUENCE IF NOT EXISTS {seq_name};")
+                    c.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{seq_name}');")
+                    c.execute(f"ALTER SEQUENCE {seq_name} OWNED BY {table}.id;")
+                    c.execute(f"""
+                        SELECT setval(
+                            '{seq_name}',
+                            COALESCE((SELECT MAX(id) FROM {table}), 1),
+                            true
+                        )
+                    """)
+                except Exception as e:
+                    print(f"⚠️ Ошибка фикса sequence для {table}: {e}")
+            conn.commit()
+
+        # вызови сразу после миграции
+        fix_sequences()
         conn.commit()
 
-    # вызови сразу после миграции
-    fix_sequences()
-    conn.commit()
+        # default settings initialization (Postgres style)
+        c.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", ("weekly_confirmed", "0"))
+        c.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", ("last_distribution_date", ""))
+        conn.commit()
 
-    # default settings initialization (Postgres style)
-    c.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", ("weekly_confirmed", "0"))
-    c.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING", ("last_distribution_date", ""))
-    conn.commit()
+        c.execute("INSERT INTO settings (key, value) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value", ("schema_version", SCHEMA_VERSION))
+        conn.commit()
+
+    # schema is in place: prepare the hot statements on the bootstrap
+    # connection too (fresh pool connections prepare at checkout)
+    _schema_ready = True
+    _prepare_statements(_thread_conn())
 
 else:
     # fallback to sqlite for local/testing use (preserves your existing DB file)
     import sqlite3
+    import threading
     DB_FILE = "telegram_promo_bot.db"
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+
+    def _new_sqlite_conn():
+        c = sqlite3.connect(DB_FILE, check_same_thread=False)
+        c.row_factory = sqlite3.Row
+        # WAL: writers no longer block readers (and vice versa), which matters
+        # because handlers hit the DB from worker threads; busy_timeout makes
+        # the rare remaining lock wait instead of raising "database is locked".
+        # journal_mode живёт в файле, остальные PRAGMA — на соединение.
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA busy_timeout=5000")
+        c.execute("PRAGMA temp_store=MEMORY")
+        c.execute("PRAGMA cache_size=-64000")
+        c.execute("PRAGMA mmap_size=268435456")
+        return c
+
+    # Своё соединение на поток (зеркало Postgres-ветки): раньше один общий
+    # connection делили run_db-потоки и event loop, и conn.commit() одного
+    # потока мог зафиксировать недописанную транзакцию другого.
+    _db_local = threading.local()
+
+    def _thread_conn():
+        c = getattr(_db_local, "conn", None)
+        if c is None:
+            c = _new_sqlite_conn()
+            _db_local.conn = c
+        return c
+
+    class _ConnectionProxy:
+        """Stands in for the old module-level conn; delegates to the per-thread connection."""
+        def commit(self):
+            _thread_conn().commit()
+        def rollback(self):
+            _thread_conn().rollback()
+        def cursor(self, *args, **kwargs):
+            return _thread_conn().cursor(*args, **kwargs)
+        def execute(self, *args, **kwargs):
+            return _thread_conn().execute(*args, **kwargs)
+
+    conn = _ConnectionProxy()
     cur = conn.cursor()
 
-    # create tables (sqlite dialect)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id SERIAL PRIMARY KEY,
-        tg_id BIGINT UNIQUE,
-        tg_username TEXT,
-        site_username TEXT,
-        role TEXT DEFAULT 'user',
-        status TEXT DEFAULT 'pending',
-        rejected_at TIMESTAMP,
-        registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS promocodes (
-        id SERIAL PRIMARY KEY,
-        code TEXT UNIQUE,
-        total_uses INTEGER,
-        used INTEGER DEFAULT 0,
-        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    );
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS distribution (
-        id SERIAL PRIMARY KEY,
-        user_id BIGINT,
-        promo_id INTEGER,
-        code TEXT,
-        count INTEGER,
-        source TEXT,
-        given_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS weekly_users (
-        id SERIAL PRIMARY KEY,
-        week_start DATE,
-        position INTEGER,
-        site_username TEXT,
-        user_id BIGINT
-    );
-    """)
+    def get_cursor():
+        # same contract as the Postgres branch (sqlite3.Row rows support
+        # ["col"] access); handlers call this regardless of backend
+        return _thread_conn().cursor()
+
+    def _db_done():
+        # упавшая до commit запись не должна держать write-lock, пока поток
+        # ждёт следующую задачу в пуле
+        c = getattr(_db_local, "conn", None)
+        if c is not None and c.in_transaction:
+            try:
+                c.rollback()
+            except Exception:
+                pass
 
-    conn.commit()
+    # mirror of the Postgres schema-version gate (PRAGMA user_version is a
+    # free local read); bump together with SCHEMA_VERSION above
+    SQLITE_SCHEMA_VERSION = 6
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()[0] != SQLITE_SCHEMA_VERSION:
+        # create tables (sqlite dialect)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            tg_id BIGINT UNIQUE,
+            tg_username TEXT,
+            site_username TEXT,
+            role TEXT DEFAULT 'user',
+            status TEXT DEFAULT 'pending',
+            rejected_at TIMESTAMP,
+            rejected_until TIMESTAMP,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
 
-    # default settings initialization (sqlite style)
-    cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("weekly_confirmed", "0"))
-    cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("last_distribution_date", ""))
-    conn.commit()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS promocodes (
+            id SERIAL PRIMARY KEY,
+            code TEXT UNIQUE,
+            total_uses INTEGER,
+            used INTEGER DEFAULT 0,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS distribution (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            promo_id INTEGER,
+            code TEXT,
+            count INTEGER,
+            source TEXT,
+            given_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS weekly_users (
+            id SERIAL PRIMARY KEY,
+            week_start DATE,
+            position INTEGER,
+            site_username TEXT,
+            user_id BIGINT
+        );
+        """)
+
+        try:
+            cur.execute("ALTER TABLE users ADD COLUMN rejected_until TIMESTAMP;")
+        except sqlite3.OperationalError:
+            pass  # column already exists
+
+        # same composite indexes as the Postgres branch
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_dist_user_given ON distribution(user_id, given_at);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_dist_user_code ON distribution(user_id, code);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_weekly_week_pos ON weekly_users(week_start, position);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_status_reg ON users(status, registered_at);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_registered ON users(registered_at);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_pending ON users(registered_at) WHERE status = 'pending';")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_weekly_week_user ON weekly_users(week_start, user_id);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_promo_added_id ON promocodes(added_at, id);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_promo_active ON promocodes(added_at, id) WHERE total_uses > used;")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_site ON users(site_username);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_dist_given_at ON distribution(given_at);")
+
+        conn.commit()
+
+        # default settings initialization (sqlite style)
+        cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("weekly_confirmed", "0"))
+        cur.execute("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", ("last_distribution_date", ""))
+        conn.commit()
+
+        cur.execute(f"PRAGMA user_version = {SQLITE_SCHEMA_VERSION}")
+        conn.commit()
 
 # ---------------- BOT / DISPATCHER / SCHEDULER ----------------
-storage = MemoryStorage()
+# With Redis configured, FSM state survives restarts and the bot can run more
+# than one worker; MemoryStorage stays the local fallback (same pattern as
+# DATABASE_URL vs the local sqlite file).
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    # imported lazily so local usage without redis installed keeps working
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(REDIS_URL)
+else:
+    storage = MemoryStorage()
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher(storage=storage)
 
 # ---------------- HELPERS ----------------
+async def run_db(fn, *args):
+    """Run blocking DB work in a worker thread so the event loop keeps pumping
+    Telegram updates; the pooled per-thread connections make this safe."""
+    def _call():
+        try:
+            return fn(*args)
+        finally:
+            _db_done()
+    return await asyncio.to_thread(_call)
+
+MAX_MESSAGE_LEN = 4000  # запас к лимиту Telegram в 4096 символов
+
+async def send_chunked(target, lines, final_markup=None):
+    # шлём длинные списки несколькими сообщениями вместо обрезания;
+    # final_markup (если задан) цепляется к последнему сообщению
+    buf = []
+    size = 0
+    for line in lines:
+        if buf and size + len(line) + 1 > MAX_MESSAGE_LEN:
+            await target.answer("\n".join(buf))
+            buf = []
+            size = 0
+        buf.append(line)
+        size += len(line) + 1
+    if buf:
+        await target.answer("\n".join(buf), reply_markup=final_markup)
+
+# шапка/подвал сообщения с промо — одни и те же для всех получателей
+PROMO_HEADER = "Привет, твой промокод за недельный топ 🎉🎉🎉\n1.5к камней\n\n"
+PROMO_FOOTER = "\n\n👉 <a href=\"https://animestars.org/promo_codes\">animestars.org</a>\n👉 <a href=\"https://asstars.tv/promo_codes\">asstars.tv</a>"
+
+SEND_CONCURRENCY = 25  # чуть ниже глобального лимита Telegram (~30 сообщений/с)
+
+async def send_many(messages):
+    # конкурентная рассылка вместо последовательных await: N отправок
+    # перекрывают сетевые задержки, семафор держит темп под лимитом,
+    # flood-wait повторяется после указанной сервером паузы
+    sem = asyncio.Semaphore(SEND_CONCURRENCY)
+    async def send_one(chat_id, text):
+        async with sem:
+            try:
+                await bot.send_message(chat_id, text)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                try:
+                    await bot.send_message(chat_id, text)
+                except Exception:
+                    pass
+            except Exception:
+                pass
+    await asyncio.gather(*(send_one(cid, text) for cid, text in messages))
+
+# single-pass replacement table; same output as html.escape but without its
+# five sequential str.replace scans (esc runs several times per rendered row)
+_HTML_ESC = str.maketrans({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;",
+})
+
 def esc(s: Optional[str]) -> str:
     if s is None:
         return "-"
-    return html.escape(str(s))
+    if isinstance(s, (int, bool)):
+        # ints/bools can't contain HTML-special chars; skip the escape scan
+        return str(s)
+    return (s if isinstance(s, str) else str(s)).translate(_HTML_ESC)
+
+# settings is a tiny, rarely-changing table: slurp it into memory once and keep
+# the dict in sync on writes, so hot handlers don't pay a DB round-trip per read.
+_settings_cache: Dict[str, str] = {}
+_settings_loaded = False
+
+def _load_settings_cache():
+    global _settings_loaded
+    c = get_cursor()
+    c.execute("SELECT key, value FROM settings")
+    _settings_cache.clear()
+    for r in c.fetchall():
+        _settings_cache[r["key"]] = r["value"]
+    _settings_loaded = True
 
 def db_get_setting(key: str) -> str:
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT value FROM settings WHERE key = %s", (key,))
-    else:
-        c.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    r = c.fetchone()
-    return r["value"] if r else ""
+    if not _settings_loaded:
+        _load_settings_cache()
+    return _settings_cache.get(key, "")
 
 def db_set_setting(key: str, value: str):
     c = get_cursor()
@@ -254,46 +543,84 @@ def db_set_setting(key: str, value: str):
         # sqlite: REPLACE INTO will insert or replace existing row
         c.execute("REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
     conn.commit()
+    _settings_cache[key] = value
+
+# week start only changes once a week, but the helper runs on nearly every
+# handler — cache the computed value for 60s instead of redoing the arithmetic
+_week_start_cache = (0.0, None)
 
 def get_week_start() -> date:
+    global _week_start_cache
+    ts, cached = _week_start_cache
+    if cached is not None and time.monotonic() - ts < 60:
+        return cached
     today = datetime.now(timezone.utc).date()
     weekday = today.weekday()  # 0=Mon ... 6=Sun
     days_since_sunday = (weekday + 1) % 7
-    return today - timedelta(days=days_since_sunday)
+    week = today - timedelta(days=days_since_sunday)
+    _week_start_cache = (time.monotonic(), week)
+    return week
 
 def find_user_by_site(site_username: str):
     c = get_cursor()
     if USE_POSTGRES:
-        c.execute("SELECT * FROM users WHERE site_username = %s", (site_username,))
+        c.execute("EXECUTE get_user_by_site (%s)", (site_username,))
     else:
         c.execute("SELECT * FROM users WHERE site_username = ?", (site_username,))
     return c.fetchone()
 
+# a user row only changes on registration/approve/reject, yet almost every
+# handler starts by loading it — read-through cache with explicit invalidation
+# at the write sites
+_user_cache: Dict[int, tuple] = {}
+_USER_CACHE_TTL = 300.0
+
+def _invalidate_user_cache(tg_id: int):
+    _user_cache.pop(tg_id, None)
+
 def find_user_by_tgid(tg_id: int):
+    hit = _user_cache.get(tg_id)
+    if hit is not None and time.monotonic() - hit[0] < _USER_CACHE_TTL:
+        return hit[1]
     c = get_cursor()
     if USE_POSTGRES:
-        c.execute("SELECT * FROM users WHERE tg_id = %s", (tg_id,))
+        c.execute("EXECUTE get_user_by_tgid (%s)", (tg_id,))
     else:
         c.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
-    return c.fetchone()
+    row = c.fetchone()
+    _user_cache[tg_id] = (time.monotonic(), row)
+    return row
 
-def user_already_has_code(tg_id: int, code: str) -> bool:
-    c = get_cursor()
+def load_issued_codes(tg_id: int, c=None) -> set:
+    # все коды пользователя одним запросом вместо SELECT на каждый код;
+    # вызывающий может передать уже открытый курсор
+    if c is None:
+        c = get_cursor()
     if USE_POSTGRES:
-        c.execute("SELECT 1 FROM distribution WHERE user_id = %s AND code = %s", (tg_id, code))
+        c.execute("SELECT code FROM distribution WHERE user_id = %s", (tg_id,))
     else:
-        c.execute("SELECT 1 FROM distribution WHERE user_id = ? AND code = ?", (tg_id, code))
-    return c.fetchone() is not None
+        c.execute("SELECT code FROM distribution WHERE user_id = ?", (tg_id,))
+    return {r["code"] for r in c.fetchall()}
+
+def available_codes_for(tg_id: int) -> List[str]:
+    # коды с остатком, которые пользователь ещё не получал (общий код givepromo-хендлеров);
+    # фильтр по остатку — в SQL (partial-индекс idx_promo_active)
+    c = get_cursor()
+    c.execute("SELECT code FROM promocodes WHERE total_uses > used ORDER BY added_at ASC, id ASC")
+    promos = c.fetchall()
+    issued = load_issued_codes(tg_id, c)
+    return [p["code"] for p in promos if p["code"] not in issued]
 
 def add_promocodes(codes: List[str], total_uses: int):
     c = get_cursor()
-    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-    for code in codes:
-        if USE_POSTGRES:
-            c.execute("INSERT INTO promocodes (code, total_uses, used, added_at) VALUES (%s, %s, 0, %s) ON CONFLICT (code) DO NOTHING", (code, total_uses, now))
-        else:
-            c.execute("INSERT OR IGNORE INTO promocodes (code, total_uses, used, added_at) VALUES (?, ?, 0, ?)", (code, total_uses, now))
+    now = datetime.now(timezone.utc).replace(tzinfo=None).isoformat(sep=" ", timespec="seconds")
+    rows = [(code, total_uses, now) for code in codes]
+    if USE_POSTGRES:
+        c.executemany("INSERT INTO promocodes (code, total_uses, used, added_at) VALUES (%s, %s, 0, %s) ON CONFLICT (code) DO NOTHING", rows)
+    else:
+        c.executemany("INSERT OR IGNORE INTO promocodes (code, total_uses, used, added_at) VALUES (?, ?, 0, ?)", rows)
     conn.commit()
+    invalidate_plan_cache()
 
 # ---------------- FSM STATES ----------------
 class RegisterState(StatesGroup):
@@ -325,12 +652,16 @@ class FindUserState(StatesGroup):
 @dp.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     tg_id = message.from_user.id
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT * FROM users WHERE tg_id = %s", (tg_id,))
-    else:
-        c.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
-    u = c.fetchone()
+
+    def _fetch_user():
+        c = get_cursor()
+        if USE_POSTGRES:
+            c.execute("SELECT * FROM users WHERE tg_id = %s", (tg_id,))
+        else:
+            c.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
+        return c.fetchone()
+
+    u = await run_db(_fetch_user)
     if u:
         status = u["status"]
         site = u["site_username"] or "-"
@@ -341,16 +672,15 @@ async def cmd_start(message: Message, state: FSMContext):
             await message.answer("⏳ Ваша заявка уже отправлена и ожидает подтверждения администратора.")
             return
         elif status == "rejected":
-            # check cooldown: rejected_at + 1 hour
-            ra = u["rejected_at"]
-            if ra:
-                try:
-                    ra_dt = datetime.fromisoformat(ra)
-                except:
-                    ra_dt = datetime.now(timezone.utc) - timedelta(hours=2)
-                if datetime.now(timezone.utc) < (ra_dt + timedelta(hours=1)):
-                    remaining = (ra_dt + timedelta(hours=1)) - datetime.now(timezone.utc)
-                    mins = int(remaining.total_seconds() // 60) + 1
+            # cooldown expiry is precomputed at reject time (rejected_until),
+            # so no timedelta arithmetic or fallback parsing per /start
+            ru = u["rejected_until"]
+            if ru:
+                if isinstance(ru, str):  # sqlite stores it as text
+                    ru = datetime.fromisoformat(ru)
+                now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+                if now_utc < ru:
+                    mins = int((ru - now_utc).total_seconds() // 60) + 1
                     await message.answer(f"❌ Ваша предыдущая заявка была отклонена. Повторная подача возможна через {mins} минут.")
                     return
             # else allow reapply
@@ -363,46 +693,51 @@ async def process_registration_nick(message: Message, state: FSMContext):
     site_nick = message.text.strip()
     tg_id = message.from_user.id
     tg_username = message.from_user.username or message.from_user.full_name or ""
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT * FROM users WHERE site_username = %s AND tg_id != %s", (site_nick, tg_id))
-    else:
-        c.execute("SELECT * FROM users WHERE site_username = ? AND tg_id != ?", (site_nick, tg_id))
-    conflict = c.fetchone()
-    if conflict and conflict["status"] == "approved":
-        await message.answer("Этот ник уже зарегистрирован другим пользователем. Если вы считаете это ошибкой, свяжитесь с администратором.")
-        await state.clear()
-        return
-    # upsert user row: create or update
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT * FROM users WHERE tg_id = %s", (tg_id,))
-    else:
-        c.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
-    existing = c.fetchone()
-    if existing:
-        # update site_username and set status pending (unless approved)
+    def _register():
+        c = get_cursor()
         if USE_POSTGRES:
-            c.execute("UPDATE users SET site_username = %s, tg_username = %s, status = 'pending', rejected_at = NULL WHERE tg_id = %s", (site_nick, tg_username, tg_id))
+            c.execute("SELECT * FROM users WHERE site_username = %s AND tg_id != %s", (site_nick, tg_id))
         else:
-            c.execute("UPDATE users SET site_username = ?, tg_username = ?, status = 'pending', rejected_at = NULL WHERE tg_id = ?", (site_nick, tg_username, tg_id))
-    else:
+            c.execute("SELECT * FROM users WHERE site_username = ? AND tg_id != ?", (site_nick, tg_id))
+        conflict = c.fetchone()
+        if conflict and conflict["status"] == "approved":
+            return False
+        # upsert user row: create or update
         if USE_POSTGRES:
-            c.execute("INSERT INTO users (tg_id, tg_username, site_username, status) VALUES (%s, %s, %s, 'pending')", (tg_id, tg_username, site_nick))
+            c.execute("SELECT * FROM users WHERE tg_id = %s", (tg_id,))
         else:
-            c.execute("INSERT INTO users (tg_id, tg_username, site_username, status) VALUES (?, ?, ?, 'pending')", (tg_id, tg_username, site_nick))
-    conn.commit()
+            c.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
+        existing = c.fetchone()
+        if existing:
+            # update site_username and set status pending (unless approved)
+            if USE_POSTGRES:
+                c.execute("UPDATE users SET site_username = %s, tg_username = %s, status = 'pending', rejected_at = NULL, rejected_until = NULL WHERE tg_id = %s", (site_nick, tg_username, tg_id))
+            else:
+                c.execute("UPDATE users SET site_username = ?, tg_username = ?, status = 'pending', rejected_at = NULL, rejected_until = NULL WHERE tg_id = ?", (site_nick, tg_username, tg_id))
+        else:
+            if USE_POSTGRES:
+                c.execute("INSERT INTO users (tg_id, tg_username, site_username, status) VALUES (%s, %s, %s, 'pending')", (tg_id, tg_username, site_nick))
+            else:
+                c.execute("INSERT INTO users (tg_id, tg_username, site_username, status) VALUES (?, ?, ?, 'pending')", (tg_id, tg_username, site_nick))
+        conn.commit()
+        _invalidate_user_cache(tg_id)
+        return True
+
+    if not await run_db(_register):
+        await message.answer("Этот ник уже зарегистрирован другим пользователем. Если вы считаете это ошибкой, свяжитесь с администратором.")
+        await state.clear()
+        return
     # notify admins with approve/reject buttons
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Одобрить", callback_data=f"approve:{tg_id}")],
         [InlineKeyboardButton(text="❌ Отклонить", callback_data=f"reject:{tg_id}")]
     ])
     admin_text = f"[Новая регистрация]\nsite: <code>{esc(site_nick)}</code>\nTG: <a href=\"tg://user?id={esc(tg_id)}\">{esc(tg_id)}</a>"
-    for admin in ADMIN_IDS:
-        try:
-            await bot.send_message(admin, admin_text, reply_markup=kb)
-        except Exception:
-            pass
+    # fan out to all admins at once instead of paying one Telegram RTT per admin
+    await asyncio.gather(
+        *(bot.send_message(admin, admin_text, reply_markup=kb) for admin in ADMIN_IDS),
+        return_exceptions=True,
+    )
     await message.answer(f"Ваша заявка отправлена администраторам. Ник: <code>{esc(site_nick)}</code>")
     await state.clear()
 
@@ -410,54 +745,56 @@ async def process_registration_nick(message: Message, state: FSMContext):
 @dp.message(Command("promo"))
 async def cmd_promo(message: Message):
     tg_id = message.from_user.id
-    user = find_user_by_tgid(tg_id)
+    user = await run_db(find_user_by_tgid, tg_id)
     if not user or user["status"] != "approved":
         await message.answer("❌ Вы не зарегистрированы или заявка ещё не одобрена.")
         return
 
     week = get_week_start()
-    # make explicit timestamp string YYYY-MM-DD HH:MM:SS (compatible with both Postgres and SQLite)
     week_start_dt = datetime.combine(week, datetime.min.time())
-    week_start_str = week_start_dt.strftime("%Y-%m-%d %H:%M:%S")
+    # sqlite stores given_at as text, so that branch keeps the string form;
+    # Postgres gets the datetime itself — a text parameter against a
+    # TIMESTAMP column forces a cast that can defeat idx_dist_user_given
+    week_start_str = week_start_dt.isoformat(sep=" ", timespec="seconds")
 
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("""
-            SELECT code
-            FROM distribution
-            WHERE user_id = %s AND given_at >= %s
-            ORDER BY given_at
-        """, (tg_id, week_start_str))
-    else:
-        c.execute("""
-            SELECT code
-            FROM distribution
-            WHERE user_id = ? AND given_at >= ?
-            ORDER BY given_at
-        """, (tg_id, week_start_str))
-    rows = c.fetchall()
+    def _fetch_week_codes():
+        c = get_cursor()
+        if USE_POSTGRES:
+            c.execute("""
+                SELECT code
+                FROM distribution
+                WHERE user_id = %s AND given_at >= %s
+                ORDER BY given_at
+            """, (tg_id, week_start_dt))
+        else:
+            c.execute("""
+                SELECT code
+                FROM distribution
+                WHERE user_id = ? AND given_at >= ?
+                ORDER BY given_at
+            """, (tg_id, week_start_str))
+        return c.fetchall()
+    rows = await run_db(_fetch_week_codes)
 
     if not rows:
         await message.answer("❌ На этой неделе вы не были в списке на промо.")
         return
 
     issued_codes = [r["code"] for r in rows]
-    header = "Привет, твой промокод за недельный топ 🎉🎉🎉\n1.5к камней\n\n"
     promo_lines = [f"{i+1}. <code>{esc(c)}</code>" for i, c in enumerate(issued_codes)]
-    footer = "\n\n👉 <a href=\"https://animestars.org/promo_codes\">animestars.org</a>\n👉 <a href=\"https://asstars.tv/promo_codes\">asstars.tv</a>"
-    await message.answer(header + "\n".join(promo_lines) + footer)
+    await message.answer(PROMO_HEADER + "\n".join(promo_lines) + PROMO_FOOTER)
 
 # ---------------- PENDING: list + approve/reject callbacks ----------------
 @dp.message(Command("pending"))
 async def cmd_pending(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT tg_id, tg_username, site_username, registered_at FROM users WHERE status = 'pending' ORDER BY registered_at")
-    else:
+
+    def _fetch_pending():
+        c = get_cursor()
         c.execute("SELECT tg_id, tg_username, site_username, registered_at FROM users WHERE status = 'pending' ORDER BY registered_at")
-    rows = c.fetchall()
+        return c.fetchall()
+    rows = await run_db(_fetch_pending)
     if not rows:
         await message.answer("Нет ожидающих подтверждения.")
         return
@@ -471,7 +808,7 @@ async def cmd_pending(message: Message):
         ])
         await message.answer(f"Заявка:\nsite: <code>{site}</code>\nid: <code>{esc(tgid)}</code>", reply_markup=kb)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("approve:"))
+@dp.callback_query(F.data.startswith("approve:"))
 async def cb_approve(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
@@ -481,12 +818,17 @@ async def cb_approve(callback: types.CallbackQuery):
         await callback.answer()
         return
     tgid = int(parts[1])
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("UPDATE users SET status='approved', rejected_at = NULL WHERE tg_id = %s", (tgid,))
-    else:
-        c.execute("UPDATE users SET status='approved', rejected_at = NULL WHERE tg_id = ?", (tgid,))
-    conn.commit()
+
+    def _approve():
+        c = get_cursor()
+        if USE_POSTGRES:
+            c.execute("UPDATE users SET status='approved', rejected_at = NULL, rejected_until = NULL WHERE tg_id = %s", (tgid,))
+        else:
+            c.execute("UPDATE users SET status='approved', rejected_at = NULL, rejected_until = NULL WHERE tg_id = ?", (tgid,))
+        conn.commit()
+        _invalidate_user_cache(tgid)
+
+    await run_db(_approve)
     try:
         await callback.message.edit_text(f"Пользователь <code>{esc(tgid)}</code> одобрен.")
     except:
@@ -497,7 +839,7 @@ async def cb_approve(callback: types.CallbackQuery):
         pass
     await callback.answer("Одобрен")
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("reject:"))
+@dp.callback_query(F.data.startswith("reject:"))
 async def cb_reject(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
@@ -507,13 +849,20 @@ async def cb_reject(callback: types.CallbackQuery):
         await callback.answer()
         return
     tgid = int(parts[1])
-    c = get_cursor()
-    now_str = datetime.now(timezone.utc).isoformat()
-    if USE_POSTGRES:
-        c.execute("UPDATE users SET status='rejected', rejected_at = %s WHERE tg_id = %s", (now_str, tgid))
-    else:
-        c.execute("UPDATE users SET status='rejected', rejected_at = ? WHERE tg_id = ?", (now_str, tgid))
-    conn.commit()
+
+    def _reject():
+        c = get_cursor()
+        now_dt = datetime.now(timezone.utc).replace(tzinfo=None)
+        now_str = now_dt.isoformat()
+        until_str = (now_dt + timedelta(hours=1)).isoformat()
+        if USE_POSTGRES:
+            c.execute("UPDATE users SET status='rejected', rejected_at = %s, rejected_until = %s WHERE tg_id = %s", (now_str, until_str, tgid))
+        else:
+            c.execute("UPDATE users SET status='rejected', rejected_at = ?, rejected_until = ? WHERE tg_id = ?", (now_str, until_str, tgid))
+        conn.commit()
+        _invalidate_user_cache(tgid)
+
+    await run_db(_reject)
     try:
         await callback.message.edit_text(f"Пользователь <code>{esc(tgid)}</code> отклонён.")
     except:
@@ -565,7 +914,7 @@ async def addpromo_uses(message: Message, state: FSMContext):
     data = await state.get_data()
     codes = [data.get("code1"), data.get("code2"), data.get("code3")]
     uses = int(data.get("uses"))
-    add_promocodes(codes, uses)
+    await run_db(add_promocodes, codes, uses)
     lines = ["✅ Промокоды добавлены:"]
     for i, ccode in enumerate(codes, start=1):
         lines.append(f"{i}. <code>{esc(ccode)}</code>")
@@ -591,29 +940,22 @@ async def process_setusers_file(message: Message, state: FSMContext):
             await message.answer("Ошибка: нужен файл с расширением .txt")
             await state.clear()
             return
-        temp_path = f"tmp_{int(datetime.now().timestamp())}_{doc.file_name}"
+        # download straight into memory — the list is a few KB, a temp file
+        # on disk was pure overhead (and a name-collision hazard)
         try:
             file = await bot.get_file(doc.file_id)
-            await bot.download_file(file.file_path, destination=temp_path)
+            buf = await bot.download_file(file.file_path)
         except Exception:
             await message.answer("Ошибка при скачивании файла. Попробуйте ещё раз.")
             await state.clear()
             return
         try:
-            with open(temp_path, "r", encoding="utf-8") as f:
-                lines = [ln.strip() for ln in f if ln.strip()]
+            text = buf.read().decode("utf-8")
         except Exception:
             await message.answer("Ошибка при чтении файла. Убедитесь в кодировке UTF-8.")
-            try:
-                os.remove(temp_path)
-            except:
-                pass
             await state.clear()
             return
-        try:
-            os.remove(temp_path)
-        except:
-            pass
+        lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
     else:
         if not message.text or message.text.strip() == "":
             await message.answer("Нет файла и нет текста. Отправьте .txt или вставьте список.")
@@ -627,25 +969,39 @@ async def process_setusers_file(message: Message, state: FSMContext):
         return
 
     week = get_week_start()
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("DELETE FROM weekly_users WHERE week_start = %s", (week,))
-    else:
-        c.execute("DELETE FROM weekly_users WHERE week_start = ?", (week,))
-    added = 0
-    missing = []
-    for idx, nick in enumerate(lines, start=1):
-        user = find_user_by_site(nick)
-        user_id = user["tg_id"] if user and user["status"] == "approved" else None
+
+    def _replace_week_list():
+        c = get_cursor()
         if USE_POSTGRES:
-            c.execute("INSERT INTO weekly_users (week_start, position, site_username, user_id) VALUES (%s, %s, %s, %s)", (week, idx, nick, user_id))
+            c.execute("DELETE FROM weekly_users WHERE week_start = %s", (week,))
+            # all listed nicks in one query instead of find_user_by_site per line
+            c.execute("SELECT site_username, tg_id, status FROM users WHERE site_username = ANY(%s)", (lines,))
         else:
-            c.execute("INSERT INTO weekly_users (week_start, position, site_username, user_id) VALUES (?, ?, ?, ?)", (week, idx, nick, user_id))
-        if user and user["status"] == "approved":
-            added += 1
+            c.execute("DELETE FROM weekly_users WHERE week_start = ?", (week,))
+            placeholders = ",".join("?" * len(lines))
+            c.execute(f"SELECT site_username, tg_id, status FROM users WHERE site_username IN ({placeholders})", lines)
+        by_site = {r["site_username"]: r for r in c.fetchall()}
+        added = 0
+        missing = []
+        rows = []
+        for idx, nick in enumerate(lines, start=1):
+            user = by_site.get(nick)
+            user_id = user["tg_id"] if user and user["status"] == "approved" else None
+            rows.append((week, idx, nick, user_id))
+            if user and user["status"] == "approved":
+                added += 1
+            else:
+                missing.append((idx, nick))
+        # one batched insert instead of a round-trip per position
+        if USE_POSTGRES:
+            c.executemany("INSERT INTO weekly_users (week_start, position, site_username, user_id) VALUES (%s, %s, %s, %s)", rows)
         else:
-            missing.append((idx, nick))
-    conn.commit()
+            c.executemany("INSERT INTO weekly_users (week_start, position, site_username, user_id) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+        invalidate_plan_cache()
+        return added, missing
+
+    added, missing = await run_db(_replace_week_list)
     reply = (
         f"✅ Список обновлён\n"
         f"Позиции: <code>{esc(len(lines))}</code>\n"
@@ -662,12 +1018,16 @@ async def cmd_missing(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     week = get_week_start()
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = %s AND user_id IS NULL ORDER BY position", (week,))
-    else:
-        c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = ? AND (user_id IS NULL) ORDER BY position", (week,))
-    rows = c.fetchall()
+
+    def _fetch_missing():
+        c = get_cursor()
+        if USE_POSTGRES:
+            c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = %s AND user_id IS NULL ORDER BY position", (week,))
+        else:
+            c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = ? AND (user_id IS NULL) ORDER BY position", (week,))
+        return c.fetchall()
+
+    rows = await run_db(_fetch_missing)
     if not rows:
         await message.answer("Пустых позиций нет.")
         return
@@ -678,69 +1038,100 @@ async def cmd_missing(message: Message):
     await message.answer("\n".join(out))
 
 # ---------------- USERS (all / free) ----------------
+# статичные меню не зависят от данных — собираем один раз при импорте
+USERS_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🟢 Все пользователи", callback_data="users_all")],
+    [InlineKeyboardButton(text="🔵 Свободные пользователи", callback_data="users_free")]
+])
+
 @dp.message(Command("users"))
 async def cmd_users(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🟢 Все пользователи", callback_data="users_all")],
-        [InlineKeyboardButton(text="🔵 Свободные пользователи", callback_data="users_free")]
-    ])
-    await message.answer("Выберите список:", reply_markup=kb)
+    await message.answer("Выберите список:", reply_markup=USERS_MENU_KB)
+
+USERS_PAGE_SIZE = 20
+USER_ROW_SEP = "───────────────"
 
-@dp.callback_query(lambda c: c.data == "users_all")
+@dp.callback_query(F.data.startswith("users_all"))
 async def cb_users_all(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
-    c = get_cursor()
-    c.execute("SELECT tg_id, site_username, tg_username, status FROM users ORDER BY registered_at")
-    rows = c.fetchall()
+    # callback_data: "users_all" (первая страница) или "users_all:<page>"
+    parts = callback.data.split(":", 1)
+    page = int(parts[1]) if len(parts) == 2 else 0
+
+    def _fetch_page():
+        c = get_cursor()
+        # страница + 1 строка, чтобы понять, есть ли следующая; не тащим всю таблицу
+        if USE_POSTGRES:
+            c.execute("SELECT tg_id, site_username, tg_username, status FROM users ORDER BY registered_at LIMIT %s OFFSET %s",
+                      (USERS_PAGE_SIZE + 1, page * USERS_PAGE_SIZE))
+        else:
+            c.execute("SELECT tg_id, site_username, tg_username, status FROM users ORDER BY registered_at LIMIT ? OFFSET ?",
+                      (USERS_PAGE_SIZE + 1, page * USERS_PAGE_SIZE))
+        return c.fetchall()
+
+    rows = await run_db(_fetch_page)
     if not rows:
-        await callback.message.edit_text("Нет зарегистрированных пользователей.")
+        if page == 0:
+            await callback.message.edit_text("Нет зарегистрированных пользователей.")
+        await callback.answer()
         return
 
+    has_next = len(rows) > USERS_PAGE_SIZE
+    rows = rows[:USERS_PAGE_SIZE]
     batch = []
-    for idx, r in enumerate(rows, start=1):
-        batch.append(f"👤 site: <code>{esc(r['site_username'] or '-')}</code>")
-        batch.append(f"🆔 id: <code>{esc(r['tg_id'])}</code>")
-        batch.append(f"🔗 <a href=\"tg://user?id={esc(r['tg_id'])}\">@{esc(r['tg_username'] or r['tg_id'])}</a>")
-        batch.append(f"📌 Статус: <code>{esc(r['status'])}</code>")
-        batch.append("───────────────")
-
-        if idx % 20 == 0:  # каждые 20 пользователей отправляем сообщение
-            await callback.message.answer("\n".join(batch))
-            batch = []
+    for r in rows:
+        tg_id = r["tg_id"]  # int: never needs escaping
+        batch.append("\n".join((
+            f"👤 site: <code>{esc(r['site_username'] or '-')}</code>",
+            f"🆔 id: <code>{tg_id}</code>",
+            f"🔗 <a href=\"tg://user?id={tg_id}\">@{esc(r['tg_username'] or tg_id)}</a>",
+            f"📌 Статус: <code>{esc(r['status'])}</code>",
+            USER_ROW_SEP,
+        )))
 
-    if batch:
-        await callback.message.answer("\n".join(batch))
+    kb = None
+    if has_next:
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="➡️ Дальше", callback_data=f"users_all:{page + 1}")]
+        ])
+    await callback.message.answer("\n".join(batch), reply_markup=kb)
+    await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "users_free")
+@dp.callback_query(F.data == "users_free")
 async def cb_users_free(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
     week = get_week_start()
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("""
-            SELECT u.tg_id, u.site_username, u.tg_username
-            FROM users u
-            WHERE u.status='approved' AND u.tg_id NOT IN (
-                SELECT user_id FROM weekly_users WHERE week_start = %s AND user_id IS NOT NULL
-            )
-            ORDER BY u.registered_at
-        """, (week,))
-    else:
-        c.execute("""
-            SELECT u.tg_id, u.site_username, u.tg_username
-            FROM users u
-            WHERE u.status='approved' AND u.tg_id NOT IN (
-                SELECT user_id FROM weekly_users WHERE week_start = ? AND user_id IS NOT NULL
-            )
-            ORDER BY u.registered_at
-        """, (week,))
-    rows = c.fetchall()
+
+    def _fetch_free():
+        c = get_cursor()
+        # NOT EXISTS вместо NOT IN: nullable user_id ломает anti-join план в Postgres
+        if USE_POSTGRES:
+            c.execute("""
+                SELECT u.tg_id, u.site_username, u.tg_username
+                FROM users u
+                WHERE u.status='approved' AND NOT EXISTS (
+                    SELECT 1 FROM weekly_users wu WHERE wu.week_start = %s AND wu.user_id = u.tg_id
+                )
+                ORDER BY u.registered_at
+            """, (week,))
+        else:
+            c.execute("""
+                SELECT u.tg_id, u.site_username, u.tg_username
+                FROM users u
+                WHERE u.status='approved' AND NOT EXISTS (
+                    SELECT 1 FROM weekly_users wu WHERE wu.week_start = ? AND wu.user_id = u.tg_id
+                )
+                ORDER BY u.registered_at
+            """, (week,))
+        return c.fetchall()
+
+    rows = await run_db(_fetch_free)
     if not rows:
         await callback.message.edit_text("Нет свободных зарегистрированных.")
         return
@@ -765,12 +1156,15 @@ async def cmd_assign_start(message: Message, state: FSMContext):
     if message.from_user.id not in ADMIN_IDS:
         return
     week = get_week_start()
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = %s AND (user_id IS NULL) ORDER BY position", (week,))
-    else:
-        c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = ? AND (user_id IS NULL) ORDER BY position", (week,))
-    rows = c.fetchall()
+    def _fetch_empty():
+        c = get_cursor()
+        if USE_POSTGRES:
+            c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = %s AND (user_id IS NULL) ORDER BY position", (week,))
+        else:
+            c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = ? AND (user_id IS NULL) ORDER BY position", (week,))
+        return c.fetchall()
+
+    rows = await run_db(_fetch_empty)
     if not rows:
         await message.answer("Нет пустых позиций для назначения.")
         return
@@ -789,63 +1183,71 @@ async def assign_got_pos(message: Message, state: FSMContext):
         await message.answer("Введите корректный номер позиции (целое число).")
         return
     week = get_week_start()
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT * FROM weekly_users WHERE week_start = %s AND position = %s", (week, pos))
-    else:
-        c.execute("SELECT * FROM weekly_users WHERE week_start = ? AND position = ?", (week, pos))
-    row = c.fetchone()
-    if not row:
+
+    def _lookup():
+        c = get_cursor()
+        if USE_POSTGRES:
+            c.execute("SELECT * FROM weekly_users WHERE week_start = %s AND position = %s", (week, pos))
+        else:
+            c.execute("SELECT * FROM weekly_users WHERE week_start = ? AND position = ?", (week, pos))
+        row = c.fetchone()
+        if not row:
+            return "no_pos", None
+        if row["user_id"]:
+            return "taken", None
+        # list available users to choose
+        if USE_POSTGRES:
+            c.execute("""
+                SELECT u.tg_id, u.site_username, u.tg_username
+                FROM users u
+                WHERE u.status='approved' AND NOT EXISTS (
+                    SELECT 1 FROM weekly_users wu WHERE wu.week_start = %s AND wu.user_id = u.tg_id
+                )
+                ORDER BY u.registered_at
+            """, (week,))
+        else:
+            c.execute("""
+                SELECT u.tg_id, u.site_username, u.tg_username
+                FROM users u
+                WHERE u.status='approved' AND NOT EXISTS (
+                    SELECT 1 FROM weekly_users wu WHERE wu.week_start = ? AND wu.user_id = u.tg_id
+                )
+                ORDER BY u.registered_at
+            """, (week,))
+        return "ok", c.fetchall()
+
+    status, users = await run_db(_lookup)
+    if status == "no_pos":
         await message.answer("Позиции с таким номером нет. Проверьте /missing.")
         await state.clear()
         return
-    if row["user_id"]:
+    if status == "taken":
         await message.answer("Эта позиция уже занята.")
         await state.clear()
         return
-    # list available users to choose
-    week = get_week_start()
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("""
-            SELECT u.tg_id, u.site_username, u.tg_username
-            FROM users u
-            WHERE u.status='approved' AND u.tg_id NOT IN (
-                SELECT user_id FROM weekly_users WHERE week_start = %s AND user_id IS NOT NULL
-            )
-            ORDER BY u.registered_at
-        """, (week,))
-    else:
-        c.execute("""
-            SELECT u.tg_id, u.site_username, u.tg_username
-            FROM users u
-            WHERE u.status='approved' AND u.tg_id NOT IN (
-                SELECT user_id FROM weekly_users WHERE week_start = ? AND user_id IS NOT NULL
-            )
-            ORDER BY u.registered_at
-        """, (week,))
-    users = c.fetchall()
     if not users:
         await message.answer("Нет свободных зарегистрированных для назначения.")
         await state.clear()
         return
-    buttons = []
-    for u in users:
-        label = f"{u['site_username']} — @{u['tg_username'] or '-'}"
-        buttons.append([
-            InlineKeyboardButton(
-                text=label,
-                callback_data=f"assign_choose:{pos}:{u['tg_id']}"
-            )
-        ])
-
+    # listcomp + явный лимит Telegram на 100 рядов кнопок
+    buttons = [
+        [InlineKeyboardButton(
+            text=f"{u['site_username']} — @{u['tg_username'] or '-'}",
+            callback_data=f"assign_choose:{pos}:{u['tg_id']}"
+        )]
+        for u in users[:100]
+    ]
     kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     await message.answer("Выберите пользователя для назначения (нажмите кнопку):", reply_markup=kb)
-    await state.update_data(position=pos)
+    # кэшируем site_username показанных кандидатов, чтобы cb_assign_choose не ходил в БД
+    await state.update_data(
+        position=pos,
+        assign_users={str(u["tg_id"]): u["site_username"] or "" for u in users[:100]}
+    )
     await state.set_state(AssignState.waiting_for_choose_user)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("assign_choose:"))
-async def cb_assign_choose(callback: types.CallbackQuery):
+@dp.callback_query(F.data.startswith("assign_choose:"))
+async def cb_assign_choose(callback: types.CallbackQuery, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
@@ -856,22 +1258,32 @@ async def cb_assign_choose(callback: types.CallbackQuery):
     pos = int(parts[1])
     tg_id = int(parts[2])
     week = get_week_start()
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT * FROM users WHERE tg_id = %s", (tg_id,))
-    else:
-        c.execute("SELECT * FROM users WHERE tg_id = ?", (tg_id,))
-    u = c.fetchone()
-    if not u:
-        await callback.answer("Пользователь не найден")
+    # site_username уже лежит в FSM-кэше из assign_got_pos; БД — только при промахе
+    data = await state.get_data()
+    site = (data.get("assign_users") or {}).get(str(tg_id))
+    if site is None:
+        u = await run_db(find_user_by_tgid, tg_id)
+        if not u:
+            await callback.answer("Пользователь не найден")
+            return
+        site = u["site_username"]
+    def _assign():
+        c = get_cursor()
+        # guard по user_id IS NULL: два админа, кликнувшие одну позицию,
+        # не перезапишут друг друга — второй апдейт просто не найдёт строку
+        if USE_POSTGRES:
+            c.execute("UPDATE weekly_users SET user_id = %s WHERE week_start = %s AND position = %s AND user_id IS NULL", (tg_id, week, pos))
+        else:
+            c.execute("UPDATE weekly_users SET user_id = ? WHERE week_start = ? AND position = ? AND user_id IS NULL", (tg_id, week, pos))
+        assigned = c.rowcount > 0
+        conn.commit()
+        return assigned
+
+    if not await run_db(_assign):
+        await callback.answer("Позиция уже занята", show_alert=True)
         return
-    if USE_POSTGRES:
-        c.execute("UPDATE weekly_users SET user_id = %s WHERE week_start = %s AND position = %s", (tg_id, week, pos))
-    else:
-        c.execute("UPDATE weekly_users SET user_id = ? WHERE week_start = ? AND position = ?", (tg_id, week, pos))
-    conn.commit()
     try:
-        await callback.message.edit_text(f"✅ Назначено: <code>{esc(u['site_username'])}</code> → позиция #{esc(pos)}")
+        await callback.message.edit_text(f"✅ Назначено: <code>{esc(site)}</code> → позиция #{pos}")
     except:
         pass
     await callback.answer()
@@ -887,23 +1299,13 @@ async def cmd_givepromo_start(message: Message, state: FSMContext):
 @dp.message(GivePromoState.waiting_for_site)
 async def givepromo_site_entered(message: Message, state: FSMContext):
     site = message.text.strip()
-    user = find_user_by_site(site)
+    user = await run_db(find_user_by_site, site)
     if not user or user["status"] != "approved":
         await message.answer("Пользователь не найден или не одобрен.")
         await state.clear()
         return
     tg_id = user["tg_id"]
-    c = get_cursor()
-    c.execute("SELECT id, code, total_uses, used FROM promocodes ORDER BY added_at ASC, id ASC")
-    promos = c.fetchall()
-    available_codes = []
-    for p in promos:
-        rem = p["total_uses"] - p["used"]
-        if rem <= 0:
-            continue
-        if user_already_has_code(tg_id, p["code"]):
-            continue
-        available_codes.append(p["code"])
+    available_codes = await run_db(available_codes_for, tg_id)
     text_lines = [f"Кому: <code>{esc(site)}</code> (id: <code>{esc(tg_id)}</code>)", ""]
     if available_codes:
         text_lines.append(f"Доступно уникальных промо: {len(available_codes)}")
@@ -912,13 +1314,15 @@ async def givepromo_site_entered(message: Message, state: FSMContext):
     else:
         text_lines.append("Доступных уникальных промо нет.")
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🟢 Выдать", callback_data=f"give_type:free:{tg_id}:{esc(site)}")]
+        # только префикс и tg_id: ник в callback_data не нужен хендлеру
+        # и легко пробивает телеграмовский лимит в 64 байта
+        [InlineKeyboardButton(text="🟢 Выдать", callback_data=f"give_type:free:{tg_id}")]
     ])
     await message.answer("\n".join(text_lines), reply_markup=kb)
     await state.update_data(site=site, tg_id=tg_id)
     await state.set_state(GivePromoState.waiting_for_choice)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("give_type:"))
+@dp.callback_query(F.data.startswith("give_type:"))
 async def cb_give_type(callback: types.CallbackQuery, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
@@ -947,23 +1351,13 @@ async def givepromo_qty(message: Message, state: FSMContext):
         return
     data = await state.get_data()
     tg_id = int(data.get("give_tg_id"))
-    c = get_cursor()
-    c.execute("SELECT id, code, total_uses, used FROM promocodes ORDER BY added_at ASC, id ASC")
-    promos = c.fetchall()
-    choices = []
-    for p in promos:
-        rem = p["total_uses"] - p["used"]
-        if rem <= 0:
-            continue
-        if user_already_has_code(tg_id, p["code"]):
-            continue
-        choices.append(p["code"])
+    choices = await run_db(available_codes_for, tg_id)
     if not choices:
         await message.answer("Нет доступных уникальных промо для выдачи этому пользователю.")
         await state.clear()
         return
     await state.update_data(qty=qty)
-    sample = "\n".join([f"{i+1}. <code>{esc(c)}</code>" for i,c in enumerate(choices[:50])])
+    sample = "\n".join(f"{i+1}. <code>{esc(c)}</code>" for i,c in enumerate(choices[:50]))
     await message.answer(f"Доступные коды (выберите {qty} уникальных, введите через пробел или в новой строке):\n{sample}")
     await state.set_state(GivePromoState.waiting_for_codes)
 
@@ -981,45 +1375,88 @@ async def givepromo_codes_entered(message: Message, state: FSMContext):
     if len(set(parts)) != len(parts):
         await message.answer("Ошибка: нельзя выдавать одинаковые промо одному пользователю.")
         return
-    c = get_cursor()
-    valid = []
-    for code in parts:
-        if USE_POSTGRES:
-            c.execute("SELECT id, total_uses, used FROM promocodes WHERE code = %s", (code,))
-        else:
-            c.execute("SELECT id, total_uses, used FROM promocodes WHERE code = ?", (code,))
-        p = c.fetchone()
-        if not p:
-            await message.answer(f"Код <code>{esc(code)}</code> не найден в базе.")
-            return
-        rem = p["total_uses"] - p["used"]
-        if rem <= 0:
-            await message.answer(f"Код <code>{esc(code)}</code> исчерпан.")
-            return
-        if user_already_has_code(tg_id, code):
-            await message.answer(f"Пользователь уже получал код <code>{esc(code)}</code> ранее.")
-            return
-        valid.append((p["id"], code))
-    # commit issuance
-    issued_codes = []
-    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-    for pid, code in valid:
+    def _issue():
+        c = get_cursor()
+        # одна выборка по всем кодам вместо SELECT на каждый
         if USE_POSTGRES:
-            c.execute("INSERT INTO distribution (user_id, promo_id, code, count, source, given_at) VALUES (%s, %s, %s, %s, %s, %s)", (tg_id, pid, code, 1, give_type, now))
-            c.execute("UPDATE promocodes SET used = used + 1 WHERE id = %s", (pid,))
+            c.execute("SELECT id, code, total_uses, used FROM promocodes WHERE code = ANY(%s)", (parts,))
         else:
-            c.execute("INSERT INTO distribution (user_id, promo_id, code, count, source, given_at) VALUES (?, ?, ?, ?, ?, ?)", (tg_id, pid, code, 1, give_type, now))
-            c.execute("UPDATE promocodes SET used = used + 1 WHERE id = ?", (pid,))
-        issued_codes.append(code)
+            marks = ",".join("?" * len(parts))
+            c.execute(f"SELECT id, code, total_uses, used FROM promocodes WHERE code IN ({marks})", parts)
+        by_code = {p["code"]: p for p in c.fetchall()}
+        issued = load_issued_codes(tg_id, c)
+        valid = []
+        for code in parts:
+            p = by_code.get(code)
+            if not p:
+                return "not_found", code
+            rem = p["total_uses"] - p["used"]
+            if rem <= 0:
+                return "exhausted", code
+            if code in issued:
+                return "already", code
+            valid.append((p["id"], code))
+        # commit issuance
+        now = datetime.now(timezone.utc).replace(tzinfo=None).isoformat(sep=" ", timespec="seconds")
+        ins_rows = [(tg_id, pid, code, 1, give_type, now) for pid, code in valid]
+        ids = [pid for pid, _ in valid]
+        # явная транзакция: либо записаны и INSERT, и инкременты used, либо ничего
+        try:
+            if USE_POSTGRES:
+                # CTE с RETURNING: вставка и инкремент used одним запросом
+                psycopg2.extras.execute_values(c, """
+                    WITH ins AS (
+                        INSERT INTO distribution (user_id, promo_id, code, count, source, given_at)
+                        VALUES %s
+                        RETURNING promo_id
+                    )
+                    UPDATE promocodes p SET used = p.used + s.cnt
+                    FROM (SELECT promo_id, COUNT(*) AS cnt FROM ins GROUP BY promo_id) s
+                    WHERE p.id = s.promo_id
+                """, ins_rows)
+            else:
+                c.executemany("INSERT INTO distribution (user_id, promo_id, code, count, source, given_at) VALUES (?, ?, ?, ?, ?, ?)", ins_rows)
+                c.executemany("UPDATE promocodes SET used = used + 1 WHERE id = ?", [(pid,) for pid in ids])
+            conn.commit()
+            invalidate_plan_cache()
+        except Exception:
+            try:
+                conn.rollback()
+            except:
+                pass
+            return "error", None
+        return "ok", [code for _, code in valid]
+
+    status, payload = await run_db(_issue)
+    if status == "not_found":
+        await message.answer(f"Код <code>{esc(payload)}</code> не найден в базе.")
+        return
+    if status == "exhausted":
+        await message.answer(f"Код <code>{esc(payload)}</code> исчерпан.")
+        return
+    if status == "already":
+        await message.answer(f"Пользователь уже получал код <code>{esc(payload)}</code> ранее.")
+        return
+    if status == "error":
+        await message.answer("Ошибка при записи выдачи, изменения откатены.")
+        await state.clear()
+        return
+    issued_codes = payload
     # notify user
+    body = "\n".join(f"{i}. <code>{esc(c)}</code>" for i, c in enumerate(issued_codes, 1))
+    text = PROMO_HEADER + body + PROMO_FOOTER
     try:
-        header = "Привет, твой промокод за недельный топ 🎉🎉🎉\n1.5к камней\n\n"
-        promo_lines = [f"{i+1}. <code>{esc(c)}</code>" for i,c in enumerate(issued_codes)]
-        footer = "\n\n👉 <a href=\"https://animestars.org/promo_codes\">animestars.org</a>\n👉 <a href=\"https://asstars.tv/promo_codes\">asstars.tv</a>"
-        await bot.send_message(tg_id, header + "\n".join(promo_lines) + footer)
-    except:
-        pass
-    await message.answer("✅ Выдано пользователю:\n" + "\n".join([f"<code>{esc(c)}</code>" for c in issued_codes]))
+        await bot.send_message(tg_id, text)
+    except TelegramRetryAfter as e:
+        # flood-wait — ждём сколько сказал сервер и повторяем, а не теряем выдачу
+        await asyncio.sleep(e.retry_after)
+        try:
+            await bot.send_message(tg_id, text)
+        except Exception as exc:
+            print(f"⚠️ Не удалось отправить промо {tg_id}: {exc}")
+    except Exception as exc:
+        print(f"⚠️ Не удалось отправить промо {tg_id}: {exc}")
+    await message.answer("✅ Выдано пользователю:\n" + "\n".join(f"<code>{esc(c)}</code>" for c in issued_codes))
     await state.clear()
 
 # ---------------- FINDUSER ----------------
@@ -1033,20 +1470,32 @@ async def cmd_finduser_start(message: Message, state: FSMContext):
 @dp.message(FindUserState.waiting_for_input)
 async def finduser_handle(message: Message, state: FSMContext):
     term = message.text.strip()
-    c = get_cursor()
-    user = None
-    if term.isdigit():
-        if USE_POSTGRES:
-            c.execute("SELECT * FROM users WHERE tg_id = %s", (int(term),))
-        else:
-            c.execute("SELECT * FROM users WHERE tg_id = ?", (int(term),))
-        user = c.fetchone()
-    else:
+    week = get_week_start()
+    # один запрос вместо двух: поиск по id или нику + позиция недельного списка через LEFT JOIN
+    # (ник тоже может быть числом, поэтому ищем по обоим полям сразу)
+    term_id = int(term) if term.isdigit() else 0
+
+    def _find():
+        c = get_cursor()
         if USE_POSTGRES:
-            c.execute("SELECT * FROM users WHERE site_username = %s", (term,))
+            c.execute("""
+                SELECT u.*, wu.position AS week_position
+                FROM users u
+                LEFT JOIN weekly_users wu ON wu.user_id = u.tg_id AND wu.week_start = %s
+                WHERE u.tg_id = %s OR u.site_username = %s
+                LIMIT 1
+            """, (week, term_id, term))
         else:
-            c.execute("SELECT * FROM users WHERE site_username = ?", (term,))
-        user = c.fetchone()
+            c.execute("""
+                SELECT u.*, wu.position AS week_position
+                FROM users u
+                LEFT JOIN weekly_users wu ON wu.user_id = u.tg_id AND wu.week_start = ?
+                WHERE u.tg_id = ? OR u.site_username = ?
+                LIMIT 1
+            """, (week, term_id, term))
+        return c.fetchone()
+
+    user = await run_db(_find)
     if not user:
         await message.answer("Пользователь не найден.")
         await state.clear()
@@ -1054,10 +1503,8 @@ async def finduser_handle(message: Message, state: FSMContext):
     site_v = esc(user["site_username"])
     tid = user["tg_id"]
     tg_v = esc(user["tg_username"])
-    week = get_week_start()
-    c.execute("SELECT position FROM weekly_users WHERE week_start = %s AND user_id = %s" if USE_POSTGRES else "SELECT position FROM weekly_users WHERE week_start = ? AND user_id = ?", (week, tid))
-    pos = c.fetchone()
-    in_list = ("✅ да (позиция #" + str(pos["position"]) + ")") if pos else "❌ нет"
+    pos = user["week_position"]
+    in_list = f"✅ да (позиция #{pos})" if pos else "❌ нет"
     text = (
         "🔎 Найден пользователь:\n"
         f"👤 Ник: <code>{site_v}</code>\n"
@@ -1073,29 +1520,32 @@ async def finduser_handle(message: Message, state: FSMContext):
     await message.answer(text, reply_markup=kb)
     await state.clear()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("find_assign:"))
+@dp.callback_query(F.data.startswith("find_assign:"))
 async def cb_find_assign(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
     tid = int(callback.data.split(":",1)[1])
     week = get_week_start()
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = %s AND (user_id IS NULL) ORDER BY position", (week,))
-    else:
-        c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = ? AND (user_id IS NULL OR) ORDER BY position", (week,))
-    rows = c.fetchall()
+
+    def _fetch_empty():
+        c = get_cursor()
+        if USE_POSTGRES:
+            c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = %s AND (user_id IS NULL) ORDER BY position", (week,))
+        else:
+            c.execute("SELECT position, site_username FROM weekly_users WHERE week_start = ? AND user_id IS NULL ORDER BY position", (week,))
+        return c.fetchall()
+
+    rows = await run_db(_fetch_empty)
     if not rows:
         await callback.message.edit_text("Нет пустых позиций для назначения.")
         return
     out = ["📌 Пустые позиции на этой неделе:"]
-    for r in rows:
-        out.append(f"#{r['position']} — {esc(r['site_username'])}")
+    out.extend(f"#{r['position']} — {esc(r['site_username'])}" for r in rows)
     out.append("\nВведите номер позиции, которую хотите назначить пользователю:")
     await callback.message.edit_text("\n".join(out))
     # store assign target mapping in settings to be used during assign flow
-    db_set_setting(f"assign_target:{tid}", "1")
+    await run_db(db_set_setting, f"assign_target:{tid}", "1")
     await callback.answer()
 
 # ---------------- PROMOSTATS ----------------
@@ -1103,43 +1553,48 @@ async def cb_find_assign(callback: types.CallbackQuery):
 async def cmd_promostats(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
-    c = get_cursor()
-    # distinct added_at values
-    if USE_POSTGRES:
-        c.execute("SELECT DISTINCT added_at FROM promocodes ORDER BY added_at DESC LIMIT 50")
-    else:
+    def _fetch_batches():
+        c = get_cursor()
+        # distinct added_at values
         c.execute("SELECT DISTINCT added_at FROM promocodes ORDER BY added_at DESC LIMIT 50")
-    rows = c.fetchall()
+        return c.fetchall()
+
+    rows = await run_db(_fetch_batches)
     if not rows:
         await message.answer("Промокоды не добавлены.")
         return
     buttons = []
     for r in rows:
         ts = r["added_at"]
-        ts_str = ts if isinstance(ts, str) else ts.strftime("%Y-%m-%d %H:%M:%S")
+        ts_str = ts if isinstance(ts, str) else ts.isoformat(sep=" ", timespec="seconds")
         buttons.append([InlineKeyboardButton(text=f"📅 {ts_str}", callback_data=f"promostats:{ts_str}")])
     kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     await message.answer("Выберите загрузку промо для просмотра статистики:", reply_markup=kb)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("promostats:"))
+@dp.callback_query(F.data.startswith("promostats:"))
 async def cb_promostats_show(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
     ts_str = callback.data.split(":",1)[1]
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("SELECT id, code, total_uses, used FROM promocodes WHERE added_at = %s ORDER BY id ASC", (ts_str,))
-    else:
-        c.execute("SELECT id, code, total_uses, used FROM promocodes WHERE added_at = ? ORDER BY id ASC", (ts_str,))
-    rows = c.fetchall()
+
+    def _fetch_stats():
+        c = get_cursor()
+        # остаток считает сервер — в Python только форматирование
+        if USE_POSTGRES:
+            c.execute("SELECT code, total_uses, (total_uses - used) AS remaining FROM promocodes WHERE added_at = %s ORDER BY id ASC", (ts_str,))
+        else:
+            c.execute("SELECT code, total_uses, (total_uses - used) AS remaining FROM promocodes WHERE added_at = ? ORDER BY id ASC", (ts_str,))
+        return c.fetchall()
+
+    rows = await run_db(_fetch_stats)
     if not rows:
         await callback.message.answer("Промокоды для этой загрузки не найдены.")
         await callback.answer()
         return
     lines = [f"📊 Статистика промо (загрузка {ts_str}):\n"]
     for r in rows:
-        left = r["total_uses"] - r["used"]
+        left = r["remaining"]
         status_emoji = "🟢" if left > 0 else "🔴"
         lines.append(f"{status_emoji} <code>{esc(r['code'])}</code> — осталось: <code>{esc(left)}</code> / всего: <code>{esc(r['total_uses'])}</code>")
     kb_del = InlineKeyboardMarkup(inline_keyboard=[
@@ -1148,7 +1603,7 @@ async def cb_promostats_show(callback: types.CallbackQuery):
     ])
     await callback.message.answer("\n".join(lines), reply_markup=kb_del)
     await callback.answer()
-@dp.callback_query(lambda c: c.data and c.data.startswith("promostats_delete:"))
+@dp.callback_query(F.data.startswith("promostats_delete:"))
 async def cb_promostats_delete(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
@@ -1161,34 +1616,43 @@ async def cb_promostats_delete(callback: types.CallbackQuery):
     await callback.message.answer(f"Вы уверены, что хотите удалить все промокоды, загруженные {ts_str}? Это удалит строки из таблицы promocodes для этой даты.", reply_markup=kb_confirm)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("promostats_delete_confirm:"))
+@dp.callback_query(F.data.startswith("promostats_delete_confirm:"))
 async def cb_promostats_delete_confirm(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
     ts_str = callback.data.split(":",1)[1]
-    c = get_cursor()
-    try:
-        if USE_POSTGRES:
-            c.execute("DELETE FROM promocodes WHERE added_at = %s", (ts_str,))
-        else:
-            c.execute("DELETE FROM promocodes WHERE added_at = ?", (ts_str,))
-        conn.commit()
+
+    def _delete():
+        c = get_cursor()
+        try:
+            if USE_POSTGRES:
+                c.execute("DELETE FROM promocodes WHERE added_at = %s", (ts_str,))
+            else:
+                c.execute("DELETE FROM promocodes WHERE added_at = ?", (ts_str,))
+            conn.commit()
+            invalidate_plan_cache()
+            return None
+        except Exception as exc:
+            if USE_POSTGRES:
+                conn.rollback()
+            return exc
+
+    err = await run_db(_delete)
+    if err is None:
         await callback.message.answer(f"Удаление промокодов, загруженных {ts_str}, выполнено.")
-    except Exception as exc:
-        if USE_POSTGRES:
-            conn.rollback()
-        await callback.message.answer(f"Ошибка при удалении: {exc}")
+    else:
+        await callback.message.answer(f"Ошибка при удалении: {err}")
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "noop")
+@dp.callback_query(F.data == "noop")
 async def cb_noop(callback: types.CallbackQuery):
     try:
         await callback.answer()
     except:
         pass
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("report_delete:"))
+@dp.callback_query(F.data.startswith("report_delete:"))
 async def cb_report_delete(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
@@ -1201,24 +1665,32 @@ async def cb_report_delete(callback: types.CallbackQuery):
     await callback.message.answer(f"Вы уверены, что хотите удалить все записи выдачи за {d}? Это удалит строки из таблицы distribution за эту дату.", reply_markup=kb_confirm)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("report_delete_confirm:"))
+@dp.callback_query(F.data.startswith("report_delete_confirm:"))
 async def cb_report_delete_confirm(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
     d = callback.data.split(":",1)[1]
-    c = get_cursor()
-    try:
-        if USE_POSTGRES:
-            c.execute("DELETE FROM distribution WHERE DATE(given_at) = %s", (d,))
-        else:
-            c.execute("DELETE FROM distribution WHERE DATE(given_at) = ?", (d,))
-        conn.commit()
+
+    def _delete():
+        c = get_cursor()
+        try:
+            if USE_POSTGRES:
+                c.execute("DELETE FROM distribution WHERE DATE(given_at) = %s", (d,))
+            else:
+                c.execute("DELETE FROM distribution WHERE DATE(given_at) = ?", (d,))
+            conn.commit()
+            return None
+        except Exception as exc:
+            if USE_POSTGRES:
+                conn.rollback()
+            return exc
+
+    err = await run_db(_delete)
+    if err is None:
         await callback.message.answer(f"Удаление записей выдач за {d} выполнено.")
-    except Exception as exc:
-        if USE_POSTGRES:
-            conn.rollback()
-        await callback.message.answer(f"Ошибка при удалении: {exc}")
+    else:
+        await callback.message.answer(f"Ошибка при удалении: {err}")
     await callback.answer()
 
     try:
@@ -1228,21 +1700,27 @@ async def cb_report_delete_confirm(callback: types.CallbackQuery):
 
 # ---------------- DISTRIBUTION ALGORITHM (same approach as earlier) ----------------
 
-def compute_allocation_ordered() -> Dict[int, List[str]]:
+def load_positions(week):
+    # позиции недельного списка одним запросом; результат передаётся
+    # в compute_allocation_ordered и переиспользуется в plan-хендлерах
+    c = get_cursor()
+    if USE_POSTGRES:
+        c.execute("SELECT position, site_username, user_id FROM weekly_users WHERE week_start = %s ORDER BY position", (week,))
+    else:
+        c.execute("SELECT position, site_username, user_id FROM weekly_users WHERE week_start = ? ORDER BY position", (week,))
+    return c.fetchall()
+
+def compute_allocation_ordered(positions=None) -> Dict[int, List[str]]:
     """
     Возвращает распределение по позициям weekly_users:
     { position_number (from weekly_users.position): [code1, code2, ...] }
     Распределение считается по числу позиций в weekly_users для текущей недели.
     """
     c = get_cursor()
-    week = get_week_start()
 
-    # 1) получаем список позиций (ordered by position)
-    if USE_POSTGRES:
-        c.execute("SELECT position, user_id FROM weekly_users WHERE week_start = %s ORDER BY position", (week,))
-    else:
-        c.execute("SELECT position, user_id FROM weekly_users WHERE week_start = ? ORDER BY position", (week,))
-    positions = c.fetchall()
+    # 1) получаем список позиций (ordered by position), если не передали готовый
+    if positions is None:
+        positions = load_positions(get_week_start())
     if not positions:
         return {}
 
@@ -1254,6 +1732,7 @@ def compute_allocation_ordered() -> Dict[int, List[str]]:
             SELECT id, code, total_uses, used
             FROM promocodes
             WHERE added_at = (SELECT MAX(added_at) FROM promocodes)
+              AND total_uses > used
             ORDER BY id ASC
         """)
     else:
@@ -1261,6 +1740,7 @@ def compute_allocation_ordered() -> Dict[int, List[str]]:
             SELECT id, code, total_uses, used
             FROM promocodes
             WHERE added_at = (SELECT MAX(added_at) FROM promocodes)
+              AND total_uses > used
             ORDER BY id ASC
         """)
     promos = c.fetchall()
@@ -1301,166 +1781,247 @@ def compute_allocation_ordered() -> Dict[int, List[str]]:
             idx += 1
 
     # 4) сопоставляем коды с позициями
+    # плоская round-robin очередь вместо вложенного сканирования promo_iter:
+    # каждый код в очереди ровно один раз, поэтому внутри позиции дубликаты невозможны
+    # Important: no per-user duplicate checks here (we allocate by positions)
     distribution_plan_by_pos: Dict[int, List[str]] = {}
-    promo_idx = 0
+    queue = deque([p["code"], p["remaining"]] for p in promo_iter)
     for pos_idx, cnt in enumerate(allocated):
         pos_number = positions[pos_idx]["position"]
         if cnt <= 0:
             continue
         codes_for_pos = []
-        used_codes_local = set()
-        for _ in range(cnt):
-            found = False
-            for offset in range(len(promo_iter)):
-                idx = (promo_idx + offset) % len(promo_iter)
-                if promo_iter[idx]["remaining"] <= 0:
-                    continue
-                cand = promo_iter[idx]["code"]
-                if cand in used_codes_local:
-                    continue
-                # Important: do NOT check user_already_has_code here (we allocate by positions)
-                promo_iter[idx]["remaining"] -= 1
-                codes_for_pos.append(cand)
-                used_codes_local.add(cand)
-                promo_idx = idx
-                found = True
-                break
-            if not found:
-                break
+        taken = []
+        while len(codes_for_pos) < cnt and queue:
+            entry = queue.popleft()
+            codes_for_pos.append(entry[0])
+            entry[1] -= 1
+            if entry[1] > 0:
+                taken.append(entry)
+        # возвращаем недоисчерпанные коды в хвост — продолжаем round-robin со следующей позиции
+        queue.extend(taken)
         if codes_for_pos:
             distribution_plan_by_pos[pos_number] = codes_for_pos
 
     return distribution_plan_by_pos
 
+# план пересчитывается при каждом клике по меню (план → подтвердить → отчёт);
+# короткий TTL-кэш по неделе избавляет от повторных пересчётов одного и того же
+_plan_cache: Dict[date, tuple] = {}
+_PLAN_CACHE_TTL = 60.0
+
+def get_cached_plan(positions=None):
+    week = get_week_start()
+    hit = _plan_cache.get(week)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    plan = compute_allocation_ordered(positions)
+    _plan_cache[week] = (time.monotonic() + _PLAN_CACHE_TTL, plan)
+    return plan
+
+def load_positions_and_plan(week=None):
+    # позиции + план одним заходом; вызывается через run_db, чтобы запросы и
+    # пересчёт аллокатора не держали event loop
+    if week is None:
+        week = get_week_start()
+    positions = load_positions(week)
+    return positions, get_cached_plan(positions)
+
+def invalidate_plan_cache():
+    # вызывается из всех мутаций входных данных плана (раздача, /addpromo,
+    # перезаливка списка недели, удаление загрузки промо) — иначе в пределах
+    # TTL можно подтвердить план, посчитанный по старым данным
+    _plan_cache.clear()
+
 # ---------------- MANUAL DISTRIBUTE (/distribute_now) ----------------
+MANUAL_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📊 Показать план", callback_data="manual_plan")],
+    [InlineKeyboardButton(text="✅ Подтвердить немедленно", callback_data="manual_confirm")],
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="manual_cancel")]
+])
+
 @dp.message(Command("distribute_now"))
 async def cmd_distribute_now(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     week = get_week_start()
-    c = get_cursor()
-    c.execute("SELECT MAX(week_start) AS last_list FROM weekly_users")
-    last_list_row = c.fetchone()
-    last_list = last_list_row["last_list"] if last_list_row else None
-    c.execute("SELECT MAX(added_at) AS last_promos FROM promocodes")
-    last_promos_row = c.fetchone()
-    last_promos = last_promos_row["last_promos"] if last_promos_row else None
 
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Показать план", callback_data="manual_plan")],
-        [InlineKeyboardButton(text="✅ Подтвердить немедленно", callback_data="manual_confirm")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="manual_cancel")]
-    ])
-    info = "⚠️ Подтвердите немедленную раздачу (без ожидания 21:07). Сначала проверьте план.\n\n"
-    info += f"📋 Последний список: {last_list}\n"
-    info += f"📦 Последние промо (added_at): {last_promos}\n\n"
-    await message.answer(info, reply_markup=kb)
+    def _fetch_last():
+        c = get_cursor()
+        c.execute("SELECT MAX(week_start) AS last_list FROM weekly_users")
+        last_list_row = c.fetchone()
+        c.execute("SELECT MAX(added_at) AS last_promos FROM promocodes")
+        last_promos_row = c.fetchone()
+        return (
+            last_list_row["last_list"] if last_list_row else None,
+            last_promos_row["last_promos"] if last_promos_row else None,
+        )
+
+    last_list, last_promos = await run_db(_fetch_last)
+
+    info = (
+        "⚠️ Подтвердите немедленную раздачу (без ожидания 21:07). Сначала проверьте план.\n\n"
+        f"📋 Последний список: {last_list}\n"
+        f"📦 Последние промо (added_at): {last_promos}\n\n"
+    )
+    await message.answer(info, reply_markup=MANUAL_MENU_KB)
 
-@dp.callback_query(lambda c: c.data == "manual_plan")
+@dp.callback_query(F.data == "manual_plan")
 async def cb_manual_plan(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
-    plan = compute_allocation_ordered()
+    positions, plan = await run_db(load_positions_and_plan)
     if not plan:
         await callback.answer("Невозможно построить план.")
         return
     out = ["📊 План распределения (ручная раздача):"]
     idx = 1
-    c = get_cursor()
-    week = get_week_start()
-    if USE_POSTGRES:
-        c.execute("SELECT position, site_username, user_id FROM weekly_users WHERE week_start = %s ORDER BY position", (week,))
-    else:
-        c.execute("SELECT position, site_username, user_id FROM weekly_users WHERE week_start = ? ORDER BY position", (week,))
-    positions = c.fetchall()
     for pos in positions:
         uid = pos["user_id"]
+        site = esc(pos["site_username"])  # экранируем один раз на позицию
         if not uid:
-            out.append(f"{idx}. {esc(pos['site_username'])} — ❌ пусто")
+            out.append(f"{idx}. {site} — ❌ пусто")
         else:
             codes = plan.get(pos['position'], [])
             if not codes:
-                out.append(f"{idx}. {esc(pos['site_username'])} — ❌ не получит промо")
+                out.append(f"{idx}. {site} — ❌ не получит промо")
             else:
-                out.append(f"{idx}. {esc(pos['site_username'])}")
+                out.append(f"{idx}. {site}")
                 for i, code in enumerate(codes, start=1):
                     out.append(f"   ├─ <code>{esc(code)}</code>")
                 suffix = "✅ (полный комплект)" if len(codes) >= 3 else f"⚠️ ({len(codes)} шт.)"
                 out.append(f"   {suffix}")
         idx += 1
-        if len(out) > 400:
-            out.append("... (обрезано)")
-            break
-    await callback.message.answer("\n".join(out))
+    await send_chunked(callback.message, out)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "manual_confirm")
+async def _execute_distribution(positions, plan, source: str) -> bool:
+    """Записывает план в БД одним батчем и рассылает уведомления.
+
+    Общий код ручной раздачи и возможных плановых запусков: батчинг,
+    единая транзакция и рассылка после коммита живут в одном месте.
+    Возвращает False, если запись не удалась (изменения откачены).
+    """
+    def _write():
+        c = get_cursor()
+        # результат идёт только в dict — сортировка на сервере не нужна;
+        # исчерпанные коды не нужны и плану, и остаточным проверкам
+        if USE_POSTGRES:
+            # FOR UPDATE: держим строки до commit, чтобы параллельный givepromo
+            # не увеличил used между чтением остатков и батчевым UPDATE
+            c.execute("SELECT id, code, total_uses, used FROM promocodes WHERE total_uses > used FOR UPDATE")
+        else:
+            c.execute("SELECT id, code, total_uses, used FROM promocodes WHERE total_uses > used")
+        promos = c.fetchall()
+        rem_map = {p["code"]:(p["id"], p["total_uses"] - p["used"]) for p in promos}
+        now = datetime.now(timezone.utc).replace(tzinfo=None).isoformat(sep=" ", timespec="seconds")
+
+        user_by_pos = {pos["position"]: pos["user_id"] for pos in positions}
+        # история выдач всех получателей одним запросом вместо
+        # SELECT на каждую пару (пользователь, код)
+        owned = set()
+        recipient_ids = [uid for uid in user_by_pos.values() if uid]
+        if recipient_ids:
+            if USE_POSTGRES:
+                c.execute("SELECT user_id, code FROM distribution WHERE user_id = ANY(%s)", (recipient_ids,))
+            else:
+                marks = ",".join("?" * len(recipient_ids))
+                c.execute(f"SELECT user_id, code FROM distribution WHERE user_id IN ({marks})", recipient_ids)
+            owned = {(r["user_id"], r["code"]) for r in c.fetchall()}
+        used_counts = Counter()  # promo_id -> сколько раз выдан за эту раздачу
+        ins_rows = []            # строки для батчевого INSERT в distribution
+        to_notify = []           # (tg_id, [codes]) — рассылаем после записи в БД
+        remaining_total = sum(rem for _, rem in rem_map.values())
+        for pos_number, codes in plan.items():
+            if remaining_total <= 0:
+                # весь запас роздан — дальше по позициям идти незачем
+                break
+            tg_id = user_by_pos.get(pos_number)
+            if not tg_id:
+                continue
+            issued = []
+            for code in codes:
+                pid, rem = rem_map.get(code, (None,0))
+                if pid is None or rem <= 0:
+                    continue
+                if (tg_id, code) in owned:
+                    continue
+                owned.add((tg_id, code))
+                ins_rows.append((tg_id, pid, code, 1, source, now))
+                used_counts[pid] += 1
+                issued.append(code)
+                rem_map[code] = (pid, rem - 1)
+                remaining_total -= 1
+            if issued:
+                to_notify.append((tg_id, issued))
+        # батчевая запись: один INSERT на все выдачи + один агрегированный UPDATE used
+        try:
+            if ins_rows:
+                if USE_POSTGRES:
+                    # INSERT и UPDATE used одним statement (как в givepromo):
+                    # счётчики агрегируются из RETURNING вставленных строк
+                    psycopg2.extras.execute_values(
+                        c,
+                        """
+                        WITH ins AS (
+                            INSERT INTO distribution (user_id, promo_id, code, count, source, given_at)
+                            VALUES %s
+                            RETURNING promo_id
+                        )
+                        UPDATE promocodes p SET used = p.used + s.cnt
+                        FROM (SELECT promo_id, COUNT(*) AS cnt FROM ins GROUP BY promo_id) s
+                        WHERE p.id = s.promo_id
+                        """,
+                        ins_rows, page_size=1000
+                    )
+                else:
+                    c.executemany("INSERT INTO distribution (user_id, promo_id, code, count, source, given_at) VALUES (?, ?, ?, ?, ?, ?)", ins_rows)
+                    c.executemany("UPDATE promocodes SET used = used + ? WHERE id = ?", [(cnt, pid) for pid, cnt in used_counts.items()])
+            conn.commit()
+            invalidate_plan_cache()
+        except Exception:
+            try:
+                conn.rollback()
+            except:
+                pass
+            return None
+        return to_notify
+
+    # FOR UPDATE и commit живут в одном потоке/на одном соединении внутри run_db
+    to_notify = await run_db(_write)
+    if to_notify is None:
+        return False
+    # уведомления строго после коммита: пользователь не узнаёт о незаписанных кодах
+    messages = [
+        (tg_id, PROMO_HEADER + "\n".join(f"{i+1}. <code>{esc(c)}</code>" for i, c in enumerate(issued)) + PROMO_FOOTER)
+        for tg_id, issued in to_notify
+    ]
+    await send_many(messages)
+    return True
+
+@dp.callback_query(F.data == "manual_confirm")
 async def cb_manual_confirm(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
-    plan = compute_allocation_ordered()
+    week = get_week_start()
+    positions, plan = await run_db(load_positions_and_plan, week)
     if not plan:
         await callback.message.edit_text("Раздача не может быть выполнена (пустой план).")
         await callback.answer()
         return
     await callback.message.edit_text("Запускаю ручную раздачу...")
     await asyncio.sleep(0.5)
-    week = get_week_start()
-    c = get_cursor()
-    c.execute("SELECT id, code, total_uses, used FROM promocodes ORDER BY added_at ASC, id ASC")
-    promos = c.fetchall()
-    rem_map = {p["code"]:(p["id"], p["total_uses"] - p["used"]) for p in promos}
-    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-
-    for pos_number, codes in plan.items():
-        # get user_id for this position
-        if USE_POSTGRES:
-            c.execute("SELECT user_id FROM weekly_users WHERE week_start = %s AND position = %s", (week, pos_number))
-        else:
-            c.execute("SELECT user_id FROM weekly_users WHERE week_start = ? AND position = ?", (week, pos_number))
-        row = c.fetchone()
-        if not row or not row.get("user_id"):
-            continue
-        tg_id = row["user_id"]
-        issued = []
-        for code in codes:
-            pid, rem = rem_map.get(code, (None,0))
-            if pid is None or rem <= 0:
-                continue
-            if user_already_has_code(tg_id, code):
-                continue
-            try:
-                if USE_POSTGRES:
-                    c.execute("INSERT INTO distribution (user_id, promo_id, code, count, source, given_at) VALUES (%s, %s, %s, %s, %s, %s)", (tg_id, pid, code, 1, "manual", now))
-                    c.execute("UPDATE promocodes SET used = used + 1 WHERE id = %s", (pid,))
-                else:
-                    c.execute("INSERT INTO distribution (user_id, promo_id, code, count, source, given_at) VALUES (?, ?, ?, ?, ?, ?)", (tg_id, pid, code, 1, "manual", now))
-                    c.execute("UPDATE promocodes SET used = used + 1 WHERE id = ?", (pid,))
-                issued.append(code)
-                rem_map[code] = (pid, rem_map.get(code, (pid,0))[1] - 1)
-            except Exception as exc:
-                try:
-                    if USE_POSTGRES:
-                        conn.rollback()
-                except:
-                    pass
-                continue
-        if issued:
-            try:
-                header = "Привет, твой промокод за недельный топ 🎉🎉🎉\n1.5к камней\n\n"
-                promo_lines = [f"{i+1}. <code>{esc(c)}</code>" for i,c in enumerate(issued)]
-                footer = "\n\n👉 <a href=\"https://animestars.org/promo_codes\">animestars.org</a>\n👉 <a href=\"https://asstars.tv/promo_codes\">asstars.tv</a>"
-                await bot.send_message(tg_id, header + "\n".join(promo_lines) + footer)
-            except:
-                pass
-    conn.commit()
-    db_set_setting("last_distribution_date", str(get_week_start()))
+    if not await _execute_distribution(positions, plan, "manual"):
+        await callback.message.edit_text("Ошибка при записи раздачи, изменения откатены.")
+        await callback.answer()
+        return
+    await run_db(db_set_setting, "last_distribution_date", str(week))
     await callback.message.edit_text("Ручная раздача выполнена.")
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "manual_cancel")
+@dp.callback_query(F.data == "manual_cancel")
 async def cb_manual_cancel(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
@@ -1472,67 +2033,59 @@ async def cb_manual_cancel(callback: types.CallbackQuery):
     await callback.answer()
 
 # ---------------- REPORT MENU (plan / results) ----------------
+REPORT_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📊 План раздачи", callback_data="report_plan")],
+    [InlineKeyboardButton(text="✅ Итоги раздачи", callback_data="report_results")]
+])
+
 @dp.message(Command("report"))
 async def cmd_report_menu(message: Message):
     if message.from_user.id not in ADMIN_IDS:
         return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 План раздачи", callback_data="report_plan")],
-        [InlineKeyboardButton(text="✅ Итоги раздачи", callback_data="report_results")]
-    ])
-    await message.answer("📝 Отчёты по промо — выберите:", reply_markup=kb)
+    await message.answer("📝 Отчёты по промо — выберите:", reply_markup=REPORT_MENU_KB)
 
-@dp.callback_query(lambda c: c.data == "report_plan")
+@dp.callback_query(F.data == "report_plan")
 async def cb_report_plan(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
-    plan = compute_allocation_ordered()
+    positions, plan = await run_db(load_positions_and_plan)
     if not plan:
         await callback.answer("План недоступен (пусто).")
         return
     out = ["📊 План раздачи:\n"]
-    c = get_cursor()
-    week = get_week_start()
-    if USE_POSTGRES:
-        c.execute("SELECT position, site_username, user_id FROM weekly_users WHERE week_start = %s ORDER BY position", (week,))
-    else:
-        c.execute("SELECT position, site_username, user_id FROM weekly_users WHERE week_start = ? ORDER BY position", (week,))
-    positions = c.fetchall()
     idx = 1
     for pos in positions:
         uid = pos["user_id"]
+        site = esc(pos["site_username"])  # экранируем один раз на позицию
         if not uid:
-            out.append(f"{idx}. {esc(pos['site_username'])} — ❌ пусто")
+            out.append(f"{idx}. {site} — ❌ пусто")
         else:
             codes = plan.get(pos['position'], [])
             if not codes:
-                out.append(f"{idx}. {esc(pos['site_username'])} — ❌ не получит промо")
+                out.append(f"{idx}. {site} — ❌ не получит промо")
             else:
-                out.append(f"{idx}. {esc(pos['site_username'])}")
+                out.append(f"{idx}. {site}")
                 for i, code in enumerate(codes, start=1):
                     out.append(f"   ├─ <code>{esc(code)}</code>")
                 suffix = "✅ (полный комплект)" if len(codes) >= 3 else f"⚠️ ({len(codes)} шт.)"
                 out.append(f"   {suffix}")
         idx += 1
-        if len(out) > 400:
-            out.append("... (обрезано)")
-            break
-    await callback.message.answer("\n".join(out))
+    await send_chunked(callback.message, out)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "report_results")
+@dp.callback_query(F.data == "report_results")
 async def cb_report_results(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
-    c = get_cursor()
-    # выбираем уникальные даты выдач (date part)
-    if USE_POSTGRES:
-        c.execute("SELECT DISTINCT DATE(given_at) AS d FROM distribution ORDER BY d DESC LIMIT 50")
-    else:
+    def _fetch_dates():
+        c = get_cursor()
+        # выбираем уникальные даты выдач (date part)
         c.execute("SELECT DISTINCT DATE(given_at) AS d FROM distribution ORDER BY d DESC LIMIT 50")
-    rows = c.fetchall()
+        return c.fetchall()
+
+    rows = await run_db(_fetch_dates)
     if not rows:
         await callback.message.answer("Выдач ещё не было.")
         await callback.answer()
@@ -1545,44 +2098,63 @@ async def cb_report_results(callback: types.CallbackQuery):
     await callback.message.answer("Выберите дату (день) выдач для показа итогов:", reply_markup=kb)
     await callback.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("report_results_show:"))
+@dp.callback_query(F.data.startswith("report_results_show:"))
 async def cb_report_results_show(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Нет прав")
         return
     d = callback.data.split(":",1)[1]
-    c = get_cursor()
-    if USE_POSTGRES:
-        c.execute("""
-            SELECT d.given_at, COALESCE(u.site_username,'-') AS site, COALESCE(u.tg_username,'-') AS tg, d.code, d.source
-            FROM distribution d
-            LEFT JOIN users u ON u.tg_id = d.user_id
-            WHERE DATE(d.given_at) = %s
-            ORDER BY d.given_at DESC
-        """, (d,))
-    else:
-        c.execute("""
-            SELECT d.given_at, COALESCE(u.site_username,'-') AS site, COALESCE(u.tg_username,'-') AS tg, d.code, d.source
-            FROM distribution d
-            LEFT JOIN users u ON u.tg_id = d.user_id
-            WHERE DATE(d.given_at) = ?
-            ORDER BY d.given_at DESC
-        """, (d,))
-    rows = c.fetchall()
+
+    def _fetch_results():
+        c = get_cursor()
+        # группировка на сервере: к клиенту едет одна агрегированная строка
+        # на пользователя вместо строки на каждую выдачу
+        if USE_POSTGRES:
+            c.execute("""
+                SELECT site, tg,
+                       string_agg(given_at::text || '|' || code || '|' || source, E'\n' ORDER BY given_at DESC) AS items
+                FROM (
+                    SELECT d.given_at, COALESCE(u.site_username,'-') AS site, COALESCE(u.tg_username,'-') AS tg, d.code, d.source
+                    FROM distribution d
+                    LEFT JOIN users u ON u.tg_id = d.user_id
+                    WHERE DATE(d.given_at) = %s
+                ) t
+                GROUP BY site, tg
+                ORDER BY site, tg
+            """, (d,))
+        else:
+            c.execute("""
+                SELECT site, tg,
+                       group_concat(given_at || '|' || code || '|' || source, char(10)) AS items
+                FROM (
+                    SELECT d.given_at, COALESCE(u.site_username,'-') AS site, COALESCE(u.tg_username,'-') AS tg, d.code, d.source
+                    FROM distribution d
+                    LEFT JOIN users u ON u.tg_id = d.user_id
+                    WHERE DATE(d.given_at) = ?
+                    ORDER BY d.given_at DESC
+                ) t
+                GROUP BY site, tg
+                ORDER BY site, tg
+            """, (d,))
+        return c.fetchall()
+
+    rows = await run_db(_fetch_results)
     if not rows:
         await callback.message.answer("За выбранную дату выдач не найдено.")
         await callback.answer()
         return
 
     parts = [f"📝 Итоги раздачи за {d}:\n"]
-    grouped = {}
+    # source повторяется в каждой строке ('manual'/'free'), экранируем по разу
+    esc_memo = {}
     for r in rows:
-        key = (r["site"], r["tg"])
-        grouped.setdefault(key, []).append((r["given_at"], r["code"], r["source"]))
-    for (site, tg), items in grouped.items():
-        parts.append(f"👤 {site} / {tg}:")
-        for it in items:
-            parts.append(f"   • {it[0]} — <code>{esc(it[1])}</code> ({esc(it[2])})")
+        parts.append(f"👤 {r['site']} / {r['tg']}:")
+        for line in r["items"].split("\n"):
+            given_at, code, src = line.split("|", 2)
+            src_esc = esc_memo.get(src)
+            if src_esc is None:
+                src_esc = esc_memo[src] = esc(src)
+            parts.append(f"   • {given_at} — <code>{esc(code)}</code> ({src_esc})")
         parts.append("───────────────")
 
     kb_del = InlineKeyboardMarkup(inline_keyboard=[
@@ -1590,14 +2162,9 @@ async def cb_report_results_show(callback: types.CallbackQuery):
         [InlineKeyboardButton(text="Отмена", callback_data="noop")]
     ])
 
-    # отправляем результат кусками по ~100 строк
-    chunk_size = 100
-    for i in range(0, len(parts), chunk_size):
-        chunk = "\n".join(parts[i:i+chunk_size])
-        if i + chunk_size >= len(parts):
-            await callback.message.answer(chunk, reply_markup=kb_del)
-        else:
-            await callback.message.answer(chunk)
+    # режем по длине, а не по числу строк: 100 длинных строк могли
+    # не влезть в лимит Telegram на 4096 символов
+    await send_chunked(callback.message, parts, final_markup=kb_del)
 
     await callback.answer()
 
@@ -1620,16 +2187,13 @@ async def set_commands():
         types.BotCommand(command="report", description="План / итоги раздачи"),
         types.BotCommand(command="distribute_now", description="Ручная раздача сейчас (подтвердить)")
     ]
-    try:
-        await bot.set_my_commands(user_cmds)
-    except:
-        pass
-    # per-admin (chat scope)
-    for aid in ADMIN_IDS:
-        try:
-            await bot.set_my_commands(user_cmds + admin_cmds, scope=types.BotCommandScopeChat(chat_id=aid))
-        except:
-            pass
+    # общий список и per-admin scope одним залпом: K+1 RTT схлопываются в один
+    all_cmds = user_cmds + admin_cmds
+    await asyncio.gather(
+        bot.set_my_commands(user_cmds),
+        *(bot.set_my_commands(all_cmds, scope=types.BotCommandScopeChat(chat_id=aid)) for aid in ADMIN_IDS),
+        return_exceptions=True,
+    )
 
 # ---------------- RUN ----------------
 PORT = int(os.getenv("PORT", 10000))  # Render сам задаёт PORT
@@ -1647,17 +2211,15 @@ async def start_webserver():
     print(f"✅ Web server started on port {PORT}")
 
 async def main():
-    # запускаем webserver и polling одновременно
-    await asyncio.gather(
-        start_webserver(),
-        dp.start_polling(bot)
-    )
-
-if __name__ == "__main__":
+    # запускаем webserver и polling одновременно; сессию закрываем на том же
+    # loop — отдельный asyncio.run в finally поднимал второй event loop
     try:
-        asyncio.run(main())
+        await asyncio.gather(
+            start_webserver(),
+            dp.start_polling(bot)
+        )
     finally:
-        try:
-            asyncio.run(bot.session.close())
-        except:
-            pass
+        await bot.session.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())